@@ -1,11 +1,23 @@
 import re
+import os
+import sys
+import json
+import zlib
 import datetime
 import functools
+import contextlib
 import logging
 import hashlib
+import time
+import heapq
+import collections
+import bisect
+import itertools
 import threading
+import weakref
 
 import jinja2
+import jinja2.sandbox
 import dateutil.parser
 import pendulum
 import requests
@@ -13,22 +25,37 @@ import sopel.formatting
 import sopel.module
 from sopel.config import StaticSection
 from sopel.config.types import ValidatedAttribute
+from sopel.tools import Identifier
 
 logger = logging.getLogger(__name__)
 
-hall_channels = {
-    'Chaosstudio Hamburg': '#rc3-chaosstudio-hamburg',
-    'Chaos-West TV': '#rc3-cwtv',
-    'ChaosZone TV': '#rc3-chaoszone',
-    'c-base': '#rc3-cbase',
-    'r3s - Monheim/Rhein': '#rc3-r3s',
-    'franconian.net': '#rc3-franconiannet',
-    'about:future stage': '#rc3-aboutfuture',
-    'Lichtung': '#rc3-xhain',
-}
+# one room per line: name | hall channel | stream slug | aliases, comma separated
+DEFAULT_ROOMS = """
+Chaosstudio Hamburg | #rc3-chaosstudio-hamburg | |
+Chaos-West TV | #rc3-cwtv | cwtv |
+ChaosZone TV | #rc3-chaoszone | chaoszone |
+ChaosZone TV Stream | | chaoszone |
+c-base | #rc3-cbase | |
+c-base Berlin | | cbase |
+r3s - Monheim/Rhein | #rc3-r3s | r3s |
+franconian.net | #rc3-franconiannet | franconiannet |
+about:future stage | #rc3-aboutfuture | |
+Lichtung | #rc3-xhain | |
+rC1 | | one |
+rC2 | | two |
+OIO/A:F Bühne | | oio |
+XHain Berlin | | xhain |
+Wikipaka Meetups | | wikipaka |
+hacc München / about:future | | hacc |
+Bitwäscherei Zürich | | bitwaescherei |
+SZ Bühne | | sendezentrum |
+"""
 
 pendulum.set_to_string_format('%d.%m. %H:%M')
 
+# returned by ScheduleDownloadTask.run when the schedule did not change since the last download
+NOT_MODIFIED = object()
+
 class ScheduleConfigSection(StaticSection):
     fahrplan_url = ValidatedAttribute('fahrplan_url',
                                       default="https://fahrplan.events.ccc.de/congress/{{year}}/Fahrplan/")
@@ -47,8 +74,26 @@ class ScheduleConfigSection(StaticSection):
             default='https://streaming.media.ccc.de/36c3/{{ stream_hall }}'
     )
     channel_topic_suffix = ValidatedAttribute('channel_topic_suffix', default='')
+    rooms = ValidatedAttribute('rooms', default=DEFAULT_ROOMS)
+    # minimum seconds between two topic changes we make in a channel
+    topic_debounce = ValidatedAttribute('topic_debounce', parse=int, default=10)
     channel = ValidatedAttribute('channel', default="#36c3-schedule")
     angel_channel = ValidatedAttribute('angel_channel', default='#signalangels')
+    # announcements due within this many seconds go to the schedule channel as one digest
+    coalesce_window = ValidatedAttribute('coalesce_window', parse=int, default=5)
+    digest_start_prefix = ValidatedAttribute('digest_start_prefix', default='NOW ')
+    digest_scheduled_start_prefix = ValidatedAttribute('digest_scheduled_start_prefix',
+                                                       default='In {{ countdown }}: ')
+    digest_separator = ValidatedAttribute('digest_separator', default=' | ')
+    # token buckets for outgoing messages: overall and per target, in messages per second
+    send_rate = ValidatedAttribute('send_rate', parse=float, default=2.0)
+    send_burst = ValidatedAttribute('send_burst', parse=int, default=10)
+    target_send_rate = ValidatedAttribute('target_send_rate', parse=float, default=1.0)
+    target_send_burst = ValidatedAttribute('target_send_burst', parse=int, default=4)
+    # rendered .search and .nextup responses kept per schedule version
+    response_cache_size = ValidatedAttribute('response_cache_size', parse=int, default=256)
+    # relative to the core homedir, empty to disable the warm-start snapshot
+    snapshot_file = ValidatedAttribute('snapshot_file', default='c3schedule.snapshot')
 
 
 def configure(config):
@@ -74,48 +119,179 @@ def setup_database(db):
     db.execute('CREATE INDEX c3schedule_subscription_session_idx ON c3schedule_subscriptions (session_id);')
 
 
-def render_jinja(template, **kwargs):
-    return jinja2.Environment().from_string(template).render(**kwargs)
+TEMPLATE_CACHE_SIZE = 128
 
-def get_accounts_for_session_id(db, session_id):
-    result = db.execute('SELECT nickserv_account FROM c3schedule_subscriptions WHERE session_id = ?', [session_id])
-    if result is None:
-        return []
+_jinja_environment = jinja2.sandbox.SandboxedEnvironment(autoescape=False)
 
-    return [r[0] for r in result.fetchall()]
 
+def reset_templates():
+    """
+    Starts over with a fresh environment, e.g. after the config has been (re)loaded.
+    """
+    global _jinja_environment
+    _jinja_environment = jinja2.sandbox.SandboxedEnvironment(autoescape=False)
+    compile_template.cache_clear()
 
-def add_nick_to_session_id(db, nick, session_id):
-    db.execute('INSERT INTO c3schedule_subscriptions (nickserv_account, session_id) VALUES (?, ?)', [nick, session_id])
 
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(source):
+    return _jinja_environment.from_string(source)
 
-def del_nick_from_session_id(db, nick, session_id):
-    db.execute('DELETE FROM c3schedule_subscriptions WHERE session_id=? AND nickserv_account=?', [session_id, nick])
 
+def render_jinja(template, **kwargs):
+    return compile_template(template).render(**kwargs)
 
-def get_account_sesssions(db, account):
-    result = db.execute('SELECT session_id FROM c3schedule_subscriptions WHERE nickserv_account=?', [account])
-    if result is None:
-        return []
+class SubscriptionStore:
+    """
+    Keeps the subscriptions in memory. Reads never touch the database, changes
+    are written through in one transaction per call.
+    """
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.Lock()
+        self._accounts = {}
+        self._sessions = {}
 
-    return [r[0] for r in result.fetchall()]
+    @classmethod
+    def load(cls, db):
+        store = cls(db)
+        with contextlib.closing(db.connect()) as conn:
+            for account, session_id in conn.execute(
+                    'SELECT nickserv_account, session_id FROM c3schedule_subscriptions'):
+                store._add(account, session_id)
+        return store
+
+    def _add(self, account, session_id):
+        self._accounts.setdefault(session_id, set()).add(account)
+        self._sessions.setdefault(account, set()).add(session_id)
+
+    def _remove(self, account, session_id):
+        for mapping, key, value in ((self._accounts, session_id, account), (self._sessions, account, session_id)):
+            values = mapping[key]
+            values.discard(value)
+            if not values:
+                del mapping[key]
+
+    def accounts(self, session_id):
+        with self._lock:
+            return list(self._accounts.get(session_id, ()))
+
+    def sessions(self, account):
+        with self._lock:
+            return list(self._sessions.get(account, ()))
+
+    def add(self, account, session_ids):
+        """
+        :return: the session ids the account was not subscribed to yet
+        """
+        with self._lock:
+            subscribed = self._sessions.get(account, ())
+            added = [session_id for session_id in dict.fromkeys(session_ids) if session_id not in subscribed]
+            if added:
+                with contextlib.closing(self.db.connect()) as conn, conn:
+                    conn.executemany(
+                        'INSERT OR IGNORE INTO c3schedule_subscriptions (nickserv_account, session_id) VALUES (?, ?)',
+                        [(account, session_id) for session_id in added])
+
+                for session_id in added:
+                    self._add(account, session_id)
+
+            return added
+
+    def remove(self, account, session_ids):
+        """
+        :return: the session ids the account was subscribed to
+        """
+        with self._lock:
+            subscribed = self._sessions.get(account, ())
+            removed = [session_id for session_id in dict.fromkeys(session_ids) if session_id in subscribed]
+            if removed:
+                with contextlib.closing(self.db.connect()) as conn, conn:
+                    conn.execute(
+                        'DELETE FROM c3schedule_subscriptions WHERE nickserv_account = ? AND session_id IN ({})'.format(
+                            ', '.join('?' * len(removed))),
+                        [account] + removed)
+
+                for session_id in removed:
+                    self._remove(account, session_id)
+
+            return removed
 
 
 def setup(bot):
     logger.info('Setup')
     bot.config.define_section('c3schedule', ScheduleConfigSection)
+    reset_templates()
+
+    stop_announcer(bot)
+    stop_outgoing(bot)
+    start_outgoing(bot)
+    stop_topics(bot)
+    start_topics(bot)
 
     bot.memory['c3schedule'] = None
+    bot.memory['c3schedule_download_task'] = None
     bot.memory['c3schedule_current_tracks'] = {}
     bot.memory['c3schedule_angels'] = {}
     bot.memory['c3schedule_questions'] = {}
+    bot.memory['c3schedule_response_cache'] = ResponseCache(bot.config.c3schedule.response_cache_size)
+    bot.memory['c3schedule_rooms'] = RoomRegistry.parse(bot.config.c3schedule.rooms)
+    bot.memory['c3schedule_accounts'] = AccountIndex.from_users(bot.users)
+    # only sent on connect, keep what we learned before a reload
+    bot.memory.setdefault('c3schedule_targmax', None)
 
     # FIXME: remove this after initial development phase (pre 33c3)
     #bot.memory['c3schedule_fake_date'] = parse_date('2016-12-27')
 
     setup_database(bot.db)
+    bot.memory['c3schedule_subscriptions'] = SubscriptionStore.load(bot.db)
+
+    load_snapshot(bot)
+    start_refresh(bot, startup=True)
+
+def shutdown(bot):
+    stop_announcer(bot)
+    stop_outgoing(bot)
+    stop_topics(bot)
+
+
+def stop_announcer(bot):
+    announcer = bot.memory.get('c3schedule_announcer')
+    if announcer is not None:
+        announcer.stop()
+        bot.memory['c3schedule_announcer'] = None
+
+
+def start_outgoing(bot):
+    config = bot.config.c3schedule
+    outgoing = bot.memory['c3schedule_outgoing'] = OutgoingQueue(
+        bot, rate=config.send_rate, burst=config.send_burst,
+        target_rate=config.target_send_rate, target_burst=config.target_send_burst)
+    outgoing.start()
+
+
+def stop_outgoing(bot):
+    outgoing = bot.memory.get('c3schedule_outgoing')
+    if outgoing is not None:
+        outgoing.stop()
+        bot.memory['c3schedule_outgoing'] = None
+
+
+def start_topics(bot):
+    topics = bot.memory['c3schedule_topics'] = TopicReconciler(
+        functools.partial(send_topic, bot), debounce=bot.config.c3schedule.topic_debounce)
+    # what we learned before a reload, channels without a topic included
+    for name, channel in list(bot.channels.items()):
+        topics.observed(name, channel.topic or '')
+    bot.memory['c3schedule_topic_day'] = None
+
+
+def stop_topics(bot):
+    topics = bot.memory.get('c3schedule_topics')
+    if topics is not None:
+        topics.stop()
+        bot.memory['c3schedule_topics'] = None
 
-    refresh_schedule(bot, startup=True)
 
 def require_account(message=None):
     """
@@ -129,7 +305,7 @@ def require_account(message=None):
         def guarded(bot, trigger, *args, **kwargs):
             if not trigger.account:
                 if message and not callable(message):
-                    bot.say(message)
+                    say(bot, trigger, message)
             else:
                 return function(bot, trigger, *args, **kwargs)
 
@@ -138,6 +314,23 @@ def require_account(message=None):
     return actual_decorator
 
 
+def require_schedule(function):
+    """
+    Guards commands that need the schedule while it is still being loaded
+    :param function:
+    :return:
+    """
+
+    @functools.wraps(function)
+    def guarded(bot, trigger, *args, **kwargs):
+        if bot.memory['c3schedule'] is None:
+            say(bot, trigger, 'The schedule has not been loaded yet. Please try again in a moment.')
+        else:
+            return function(bot, trigger, *args, **kwargs)
+
+    return guarded
+
+
 def get_now(bot):
     now = pendulum.now('Europe/Berlin')
     if 'c3schedule_fake_date' in bot.memory:
@@ -147,6 +340,12 @@ def get_now(bot):
     return now
 
 
+def minute_bucket(bot, now=None):
+    if now is None:
+        now = get_now(bot)
+    return int(now.timestamp() // 60)
+
+
 def get_today(bot):
     return bot.memory.get('c3schedule_fake_date', pendulum.now('Europe/Berlin').date())
 
@@ -155,88 +354,163 @@ def get_today(bot):
 @sopel.module.require_privmsg()
 @sopel.module.rate(user=10)
 def show_help(bot, trigger):
-    bot.say(
+    say(bot, trigger,
         "I'm here to help you attend the sessions you want to attend. You can ask me to remind you about upcoming sessions and changes to those.")
-    bot.say("I understand the following commands:")
-    bot.say(
+    say(bot, trigger, "I understand the following commands:")
+    say(bot, trigger,
         sopel.formatting.CONTROL_BOLD + ".info <id>" + sopel.formatting.CONTROL_NORMAL + " ‒ Get information (including the URL to the Fahrplan) for a session")
-    bot.say(
-        sopel.formatting.CONTROL_BOLD + ".subscribe <id>" + sopel.formatting.CONTROL_NORMAL + " ‒ Subscribe to a session. This will enable notifications. (Reminders, Changes)")
-    bot.say(
-        sopel.formatting.CONTROL_BOLD + '.unsubscribe <id>' + sopel.formatting.CONTROL_NORMAL + " ‒ Unsubscribe from a session. Using ALL as id will remove all sessions.")
-    bot.say(
+    say(bot, trigger,
+        sopel.formatting.CONTROL_BOLD + ".subscribe <id> [<id> ...]" + sopel.formatting.CONTROL_NORMAL + " ‒ Subscribe to sessions. This will enable notifications. (Reminders, Changes)")
+    say(bot, trigger,
+        "Instead of ids you can use " + sopel.formatting.CONTROL_BOLD + "track:<name>" + sopel.formatting.CONTROL_NORMAL + ", " +
+        sopel.formatting.CONTROL_BOLD + "speaker:<name>" + sopel.formatting.CONTROL_NORMAL + " or " +
+        sopel.formatting.CONTROL_BOLD + "day:<1, 2, ... or 2042-02-03>" + sopel.formatting.CONTROL_NORMAL + " to (un)subscribe all their sessions.")
+    say(bot, trigger,
+        sopel.formatting.CONTROL_BOLD + '.unsubscribe <id> [<id> ...]' + sopel.formatting.CONTROL_NORMAL + " ‒ Unsubscribe from sessions. Using ALL as id will remove all sessions.")
+    say(bot, trigger,
         sopel.formatting.CONTROL_BOLD + '.schedule' + sopel.formatting.CONTROL_NORMAL + " ‒ View your personal (upcoming) schedule."
     )
-    bot.say(sopel.formatting.CONTROL_BOLD + '.search' + sopel.formatting.CONTROL_NORMAL + " ‒ Search for a session")
-    bot.say(sopel.formatting.CONTROL_BOLD + '.nextup' + sopel.formatting.CONTROL_NORMAL + " ‒ See what is coming up")
+    say(bot, trigger, sopel.formatting.CONTROL_BOLD + '.search' + sopel.formatting.CONTROL_NORMAL + " ‒ Search for a session, see .search for filters")
+    say(bot, trigger, sopel.formatting.CONTROL_BOLD + '.nextup' + sopel.formatting.CONTROL_NORMAL + " ‒ See what is coming up")
 
 
 @sopel.module.commands('search')
 @sopel.module.require_privmsg()
 @require_account(message='You can only view your personal schedule with a nickserv account')
 @sopel.module.rate(user=1)
+@require_schedule
 def search_session(bot, trigger):
-    search_string = trigger.group(3)
+    search_string = trigger.group(2)
 
     if search_string is None:
-        bot.say('Usage: .search <term>')
-        bot.say('If you include the string `do_not_record` it will match talks that have that flag set.')
+        say(bot, trigger, 'Usage: .search [room:<room>] [track:<track>] [lang:<language>] [type:<type>] [day:<day>] '
+                          '[after:<14:00>] [speaker:<name>] [<term> ...]')
+        say(bot, trigger, 'Use quotes for values with spaces, e.g. room:"Saal 1".')
+        say(bot, trigger, 'If you include the string `do_not_record` it will match talks that have that flag set.')
         return
 
     schedule = bot.memory['c3schedule']
     RESULT_LIMIT = 10
 
-    sessions = schedule.search_sessions(search_string, max_results=RESULT_LIMIT)
+    query = ' '.join(search_string.lower().split())
+    # after: is relative to the current time
+    key = ('search', query, schedule.hashsum, minute_bucket(bot) if 'after:' in query else None)
+    cache = bot.memory['c3schedule_response_cache']
+    lines = cache.get(key)
 
-    if len(sessions) == 0:
-        bot.say("No results found.")
-        return
+    if lines is None:
+        try:
+            mask, search_string = parse_search_query(bot, schedule, search_string)
+        except ValueError as e:
+            say(bot, trigger, 'Sorry I do not understand {}'.format(e))
+            return
 
-    bot.say('Here are the results (max {}):'.format(RESULT_LIMIT))
-    for session in sessions:
-        bot.say(session.format_summary())
+        sessions = schedule.search_sessions(search_string, max_results=RESULT_LIMIT, mask=mask)
+
+        if len(sessions) == 0:
+            lines = ["No results found."]
+        else:
+            lines = ['Here are the results (max {}):'.format(RESULT_LIMIT)]
+            lines.extend(session.format_summary() for session in sessions)
+
+        cache.put(key, lines)
+
+    for line in lines:
+        say(bot, trigger, line)
+
+
+SEARCH_FILTER_RE = re.compile(r'(?<!\S)(\w+):("[^"]*"|\S+)')
+SEARCH_FACETS = ('room', 'track', 'lang', 'type', 'day', 'speaker')
+
+
+def parse_search_time(bot, value):
+    if value.lower() == 'now':
+        return get_now(bot)
+
+    try:
+        hour, minute = value.split(':')
+        return get_now(bot).replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+    except ValueError:
+        pass
+
+    try:
+        return parse_day(value)
+    except (ValueError, OverflowError):
+        raise ValueError('after:' + value)
+
+
+def parse_search_query(bot, schedule, query):
+    """
+    Splits the filters (facet:value) off a .search query and intersects their bitsets.
+    :return: the bitset (None without filters), the remaining text
+    :raises ValueError: for a filter value that is not understood
+    """
+    mask = None
+
+    def apply_filter(match):
+        nonlocal mask
+        facet, value = match.group(1).lower(), match.group(2).strip('"')
+        if facet in SEARCH_FACETS:
+            bits = schedule.facet_mask(facet, value)
+        elif facet == 'after':
+            bits = schedule.starting_after_mask(parse_search_time(bot, value))
+        else:
+            return match.group(0)
+
+        mask = bits if mask is None else mask & bits
+        return ''
+
+    text = SEARCH_FILTER_RE.sub(apply_filter, query)
+    return mask, text
 
 
 @sopel.module.commands('nextup')
 @sopel.module.require_privmsg()
 @sopel.module.rate(user=10)
+@require_schedule
 def show_nextup(bot, trigger):
     schedule = bot.memory['c3schedule']
 
     now = get_now(bot)
-    sessions = [session for session in schedule.isessions() if session.date >= now]
-    next_sessions = sorted(sessions, key=lambda session: session.date)[:6]
+    key = ('nextup', schedule.hashsum, minute_bucket(bot, now))
+    cache = bot.memory['c3schedule_response_cache']
+    lines = cache.get(key)
 
-    if len(next_sessions) == 0:
-        bot.say('Sorry but thats it. No more sessions :(')
-    else:
-        bot.say('Here is what is coming up next:')
-        for session in next_sessions:
-            bot.say(session.format_summary())
+    if lines is None:
+        next_sessions = schedule.next_sessions(now, 6)
+
+        if len(next_sessions) == 0:
+            lines = ['Sorry but thats it. No more sessions :(']
+        else:
+            lines = ['Here is what is coming up next:']
+            lines.extend(session.format_summary() for session in next_sessions)
+
+        cache.put(key, lines)
+
+    for line in lines:
+        say(bot, trigger, line)
 
 
 @sopel.module.commands('schedule')
 @sopel.module.require_privmsg()
 @require_account(message='You can only view your personal schedule with a nickserv account')
 @sopel.module.rate(user=10)
+@require_schedule
 def show_personal_schedule(bot, trigger):
-    session_ids = get_account_sesssions(bot.db, trigger.account)
+    session_ids = bot.memory['c3schedule_subscriptions'].sessions(trigger.account)
 
     if not session_ids:
-        bot.say('You are not subscribed to any sessions yet.')
+        say(bot, trigger, 'You are not subscribed to any sessions yet.')
         return
 
     # resolve sessions to objects
     schedule = bot.memory['c3schedule']
-    sessions = schedule.get_sessions(session_ids)
+    sessions = schedule.upcoming_sessions(session_ids, get_now(bot))
 
-    now = get_now(bot)
-    sessions = [session for session in sessions if session.date >= now or session.date + session.duration >= now]
-
-    bot.say('Your personal (upcoming) schedule:')
+    say(bot, trigger, 'Your personal (upcoming) schedule:')
 
     for session in sessions:
-        bot.say(session.format_summary())
+        say(bot, trigger, session.format_summary())
 
 
 @sopel.module.commands('list')
@@ -244,73 +518,118 @@ def show_personal_schedule(bot, trigger):
 @sopel.module.rate(user=10)
 @require_account(
     message='You can only view your personal list of subscriptions while being authenticated with nickserv')
+@require_schedule
 def show_subscription_list(bot, trigger):
-    session_ids = get_account_sesssions(bot.db, trigger.account)
+    session_ids = bot.memory['c3schedule_subscriptions'].sessions(trigger.account)
 
     if len(session_ids) == 0:
-        bot.say('You do not have any subscriptions.')
+        say(bot, trigger, 'You do not have any subscriptions.')
         return
 
     # resolve sessions to objects
     schedule = bot.memory['c3schedule']
     sessions = schedule.get_sessions(session_ids)
 
-    bot.say('Your subscriptions:')
+    say(bot, trigger, 'Your subscriptions:')
     for session in sessions:
-        bot.say(session.format_summary())
+        say(bot, trigger, session.format_summary())
 
 
 @sopel.module.commands('info')
 @sopel.module.require_privmsg()
 @sopel.module.rate(user=3)
+@require_schedule
 def show_info(bot, trigger):
     try:
         session_id = int(trigger.group(3))
     except (IndexError, TypeError):
-        bot.say('Usage: .info <id>')
+        say(bot, trigger, 'Usage: .info <id>')
     else:
         session = bot.memory['c3schedule'].get_session(session_id)
         if session is None:
-            bot.say('Sorry I could not find a session with that id')
+            say(bot, trigger, 'Sorry I could not find a session with that id')
             return
 
-        bot.say(session.format_summary())
+        say(bot, trigger, session.format_summary())
 
         if session.subtitle != '' or session.abstract != '':
-            bot.say('\t{subtitle} ‒ {abstract}'.format(
+            say(bot, trigger, '\t{subtitle} ‒ {abstract}'.format(
                 subtitle=session.subtitle, abstract=session.abstract),
                 max_messages=2)
-        bot.say('More in the Fahrplan at <' + session.url(bot) + '>')
+        say(bot, trigger, 'More in the Fahrplan at <' + session.url(bot) + '>')
+
+
+SESSION_SELECTORS = ('track', 'speaker', 'day')
+
+
+def select_sessions(schedule, arg):
+    """
+    Resolves the argument of .subscribe/.unsubscribe to sessions. It is either a
+    list of session ids or a single `track:`, `speaker:` or `day:` selector.
+    :return: the sessions, the ids that could not be found
+    :raises ValueError: on malformed input
+    """
+    arg = arg.strip()
+    selector, sep, value = arg.partition(':')
+    selector = selector.strip().lower()
+
+    if sep and selector in SESSION_SELECTORS:
+        value = value.strip()
+        if not value:
+            raise ValueError(arg)
+
+        if selector == 'track':
+            return schedule.sessions_by_track(value), []
+        elif selector == 'speaker':
+            return schedule.sessions_by_speaker(value), []
+        else:
+            return schedule.sessions_by_day(value), []
+
+    session_ids = list(dict.fromkeys(int(session_id) for session_id in re.split(r'[\s,]+', arg) if session_id))
+    if not session_ids:
+        raise ValueError(arg)
+
+    sessions = schedule.get_sessions(session_ids)
+    found = set(session.id for session in sessions)
+    return sessions, [session_id for session_id in session_ids if session_id not in found]
 
 
 @sopel.module.commands('subscribe')
 @sopel.module.require_privmsg()
 @require_account(message='You can only subscribe with a valid nickserv account')
 @sopel.module.rate(user=0)
+@require_schedule
 def subscribe_to_session(bot, trigger):
     try:
-        session_id = int(trigger.group(3))
-    except (IndexError, ValueError):
-        bot.say('Usage: .subscribe <id>')
-    else:
-        session = bot.memory['c3schedule'].get_session(session_id)
+        sessions, unknown = select_sessions(bot.memory['c3schedule'], trigger.group(2) or '')
+    except ValueError:
+        say(bot, trigger, 'Usage: .subscribe <id> [<id> ...] | track:<name> | speaker:<name> | day:<day>')
+        return
 
-        if session is None:
-            bot.say('Sorry I could not find a session with that id')
-            return
+    if unknown:
+        say(bot, trigger, 'Sorry I could not find sessions with the ids {}'.format(', '.join(map(str, unknown))))
+    if not sessions:
+        if not unknown:
+            say(bot, trigger, 'Sorry I could not find any sessions for that')
+        return
 
-        session_ids = get_account_sesssions(bot.db, trigger.account)
+    added = bot.memory['c3schedule_subscriptions'].add(trigger.account, [session.id for session in sessions])
 
-        if session_id in session_ids:
-            bot.say('You are already subscribed to that session')
+    if len(sessions) == 1:
+        session = sessions[0]
+        if not added:
+            say(bot, trigger, 'You are already subscribed to that session')
             return
 
-        add_nick_to_session_id(bot.db, trigger.account, session.id)
-        bot.say('You are now subscribed to {} ({})'.format(session.title, session.id))
+        say(bot, trigger, 'You are now subscribed to {} ({})'.format(session.title, session.id))
         if session.date < get_now(bot):
-            bot.say(
+            say(bot, trigger,
                 'The session is in the past. You might not get any notifications about this one. Check the fahrplan at {}'.format(
                     session.url(bot)))
+        return
+
+    say(bot, trigger, 'You are now subscribed to {} more sessions ({} matched, the others you already had).'.format(
+        len(added), len(sessions)))
 
 
 @sopel.module.commands('unsubscribe')
@@ -318,28 +637,39 @@ def subscribe_to_session(bot, trigger):
 @require_account(message='You can only unsubscribe with a valid nickserv account')
 @sopel.module.rate(user=1)
 def unsubscribe_from_session(bot, trigger):
-    try:
-        session_id = trigger.group(3).lower()
-        if session_id != 'all':
-            session_id = int(session_id)
-    except (IndexError, ValueError, TypeError):
-        bot.say('Usage: .unsubscribe <id>')
-    else:
-        sessions = get_account_sesssions(bot.db, trigger.account)
+    subscriptions = bot.memory['c3schedule_subscriptions']
+    arg = (trigger.group(2) or '').strip()
 
-        if session_id == 'all':
-            for session_id in sessions:
-                del_nick_from_session_id(bot.db, trigger.account, session_id)
+    if arg.lower() == 'all':
+        subscriptions.remove(trigger.account, subscriptions.sessions(trigger.account))
+        say(bot, trigger, 'I unsubscribed you from all sessions')
+        return
 
-            bot.say('I unsubscribed you from all sessions')
+    schedule = bot.memory['c3schedule']
+    try:
+        if schedule is None:
+            # ids still work while the schedule is loading
+            session_ids = [int(session_id) for session_id in re.split(r'[\s,]+', arg) if session_id]
+            if not session_ids:
+                raise ValueError(arg)
         else:
-            if session_id not in sessions:
-                bot.say('You are not subscribed to {}'.format(session_id))
-                return
+            sessions, unknown = select_sessions(schedule, arg)
+            # subscriptions to sessions that vanished from the schedule can be removed too
+            session_ids = [session.id for session in sessions] + unknown
+    except ValueError:
+        say(bot, trigger, 'Usage: .unsubscribe <id> [<id> ...] | track:<name> | speaker:<name> | day:<day> | all')
+        return
 
-            del_nick_from_session_id(bot.db, trigger.account, session_id)
+    removed = subscriptions.remove(trigger.account, session_ids)
 
-            bot.say('You are now unsubscribed from {}.'.format(session_id))
+    if len(session_ids) == 1:
+        if not removed:
+            say(bot, trigger, 'You are not subscribed to {}'.format(session_ids[0]))
+        else:
+            say(bot, trigger, 'You are now unsubscribed from {}.'.format(session_ids[0]))
+        return
+
+    say(bot, trigger, 'You are now unsubscribed from {} sessions.'.format(len(removed)))
 
 
 @sopel.module.commands('update')
@@ -349,44 +679,102 @@ def trigger_update(bot, trigger):
     update_topic(bot)
 
 
+@sopel.module.commands('c3stats')
+@sopel.module.require_admin('You must be an admin for this command')
+def show_stats(bot, trigger):
+    announcer = bot.memory.get('c3schedule_announcer')
+    say(bot, trigger, 'Pending announcements: {}'.format(announcer.pending if announcer else 0))
+
+    cache = bot.memory['c3schedule_response_cache']
+    say(bot, trigger, 'Response cache: {} entries, {} hits, {} misses'.format(len(cache), cache.hits, cache.misses))
+
+    outgoing = bot.memory.get('c3schedule_outgoing')
+    if outgoing:
+        for priority, stats in sorted(outgoing.stats().items()):
+            say(bot, trigger, 'Outgoing {}: {queued} queued, {sent} sent, wait avg {average_wait:.2f}s max {max_wait:.2f}s'.format(
+                PRIORITY_NAMES[priority], **stats))
+
+
 @sopel.module.commands('fakedate')
 @sopel.module.require_admin('You must be an admin for this command')
 def set_fake_date(bot, trigger):
     try:
         date = trigger.group(3)
     except IndexError:
-        bot.reply('Usage: .fakedate 2042-02-03')
+        reply(bot, trigger, 'Usage: .fakedate 2042-02-03')
     else:
 
         if date.lower() == 'none':
             del bot.memory['c3schedule_fake_date']
-            bot.say('Remove fake date.')
+            say(bot, trigger, 'Remove fake date.')
             return
         else:
             try:
                 date = parse_date(date)
             except:
-                bot.say('Failed to parse date. Format should be 2042-02-03')
+                say(bot, trigger, 'Failed to parse date. Format should be 2042-02-03')
             else:
                 bot.memory['c3schedule_fake_date'] = date
-                bot.say('Fake date set to %s' % date)
+                say(bot, trigger, 'Fake date set to %s' % date)
 
 
 def set_topic(bot, channel, topic):
-    bot.write(('TOPIC', channel + ' :' + topic))
+    """
+    Makes `topic` the topic of `channel`, see TopicReconciler.
+    """
+    topics = bot.memory.get('c3schedule_topics')
+    if topics is None:
+        send_topic(bot, channel, topic)
+    else:
+        topics.set(channel, topic)
 
 
-def hall_channel_from_str(arg):
-    lower_hall_channels = dict((k.lower(), v) for (k,v) in hall_channels.items())
-    lower_hall_channels.update(dict((v.lower(), v) for v in hall_channels.values()))
-    lower_hall_channels.update(dict((v.lower().lstrip('#'), v) for v in hall_channels.values()))
+def send_topic(bot, channel, topic):
+    outgoing = bot.memory.get('c3schedule_outgoing')
+    if outgoing is None:
+        bot.write(('TOPIC', channel + ' :' + topic))
+    else:
+        outgoing.put(PRIORITY_ANNOUNCEMENT, 'TOPIC', channel, topic)
 
-    if not arg or (arg.lower() not in lower_hall_channels and arg not in hall_channels.values()):
-        return None
 
-    channel = lower_hall_channels[arg.lower()] if arg.lower() in lower_hall_channels else arg
+def send_message(bot, target, text, priority, max_messages=1):
+    outgoing = bot.memory.get('c3schedule_outgoing')
+    if outgoing is None:
+        bot.msg(target, text, max_messages)
+    else:
+        outgoing.put(priority, 'PRIVMSG', target, text, max_messages)
+
 
-    return channel
+def say(bot, trigger, text, max_messages=1):
+    """
+    Replies to a command. Replies queue up behind announcements and notifications.
+    """
+    send_message(bot, trigger.sender, text, PRIORITY_REPLY, max_messages=max_messages)
+
+
+def reply(bot, trigger, text):
+    """
+    Like say, addressed to the user who sent the command as bot.reply does.
+    """
+    say(bot, trigger, '{}: {}'.format(trigger.nick, text))
+
+
+def get_rooms(bot):
+    """
+    The room registry for the current value of the rooms setting.
+    """
+    value = bot.config.c3schedule.rooms
+    rooms = bot.memory.get('c3schedule_rooms')
+    if rooms is None or rooms.source != value:
+        rooms = bot.memory['c3schedule_rooms'] = RoomRegistry.parse(value)
+    return rooms
+
+
+def hall_channel_from_str(bot, arg):
+    if not arg:
+        return None
+
+    return get_rooms(bot).channel_from_str(arg)
 
 @sopel.module.commands('question')
 @sopel.module.require_chanmsg()
@@ -394,20 +782,20 @@ def hall_channel_from_str(arg):
 def ask_question(bot, trigger):
     channel = trigger.sender
 
-    if channel in hall_channels.keys():
+    if get_rooms(bot).get(channel):
         logger.info("Got question outside of hall channel. Ignoring.")
-        bot.reply('You can only ask questions in hall channels.')
+        reply(bot, trigger, 'You can only ask questions in hall channels.')
         return
 
     question = trigger.group(3)
     if question is None or question == "":
-        bot.reply('Usage: .question <question>')
+        reply(bot, trigger, 'Usage: .question <question>')
         return
 
     questions = bot.memory['c3schedule_questions'].get(channel, [])
     questions += [ (trigger.nick, question) ]
     bot.memory['c3schedule_questions'][channel] = questions
-    bot.reply('Question noted')
+    reply(bot, trigger, 'Question noted')
 
 
 @sopel.module.commands('questions')
@@ -416,19 +804,19 @@ def list_questions(bot, trigger):
     channel = trigger.group(3)
 
     if channel is None:
-        bot.reply('Usage: .questions <#channel>')
+        reply(bot, trigger, 'Usage: .questions <#channel>')
         return
 
-    channel = hall_channel_from_str(channel)
+    channel = hall_channel_from_str(bot, channel)
 
     if channel is None:
-        bot.reply('Unknown hall channel')
+        reply(bot, trigger, 'Unknown hall channel')
         return
 
     questions = bot.memory['c3schedule_questions'].get(channel, [])
     for (i, (user, question)) in enumerate(questions):
-        bot.reply('[{i}] {user} — {question}'.format(i=i, user=user, question=question))
-    bot.reply('End of list ({count} questions)'.format(count=len(questions)))
+        reply(bot, trigger, '[{i}] {user} — {question}'.format(i=i, user=user, question=question))
+    reply(bot, trigger, 'End of list ({count} questions)'.format(count=len(questions)))
 
 
 @sopel.module.commands('clearquestions')
@@ -439,13 +827,13 @@ def clear_questions(bot, trigger):
     q_channel = trigger.group(3)
 
     if q_channel is None:
-        bot.reply('Usage: .clearquestions <#channel>')
+        reply(bot, trigger, 'Usage: .clearquestions <#channel>')
         return
 
-    channel = hall_channel_from_str(q_channel)
+    channel = hall_channel_from_str(bot, q_channel)
 
     if channel is None:
-        bot.reply('Unknown hall channel')
+        reply(bot, trigger, 'Unknown hall channel')
         return
 
     is_current_sa = bot.memory['c3schedule_angels'].get(channel) == trigger.nick
@@ -459,12 +847,33 @@ def clear_questions(bot, trigger):
     if channel in bot.memory['c3schedule_questions']:
         bot.memory['c3schedule_questions'] = []
 
-    bot.reply('Questions cleared')
+    reply(bot, trigger, 'Questions cleared')
 
 
 def get_topic(bot, channel):
-    lowercase_channel_topics = dict((k.lower(), v.topic) for (k, v) in bot.channels.items())
-    return lowercase_channel_topics[channel.lower()]
+    """
+    The topic `channel` has according to the server, None if it is not known yet.
+    """
+    return bot.memory['c3schedule_topics'].topic(channel)
+
+
+@sopel.module.event('TOPIC', '331', '332')
+@sopel.module.rule('.*')
+@sopel.module.priority('low')
+@sopel.module.thread(False)
+@sopel.module.unblockable
+def track_topic(bot, trigger):
+    ours = False
+    if trigger.event == 'TOPIC':
+        channel, topic = trigger.args[0], trigger.args[-1]
+        ours = trigger.nick == bot.nick
+    elif trigger.event == '332':
+        channel, topic = trigger.args[1], trigger.args[-1]
+    else:
+        # RPL_NOTOPIC
+        channel, topic = trigger.args[1], ''
+
+    bot.memory['c3schedule_topics'].observed(channel, topic, ours=ours)
 
 
 @sopel.module.commands('signal')
@@ -478,10 +887,10 @@ def become(bot, trigger):
         return
 
     arg = trigger.group(2)
-    channel = hall_channel_from_str(arg)
+    channel = hall_channel_from_str(bot, arg)
 
     if channel is None:
-        bot.reply('Unknown hall channel')
+        reply(bot, trigger, 'Unknown hall channel')
         return
 
     old_nick = bot.memory['c3schedule_angels'].get(channel)
@@ -492,15 +901,15 @@ def become(bot, trigger):
 
     bot.write(['MODE', channel, '+o', trigger.nick])
 
-    if old_nick:
-        old_topic = get_topic(bot, channel)
+    old_topic = get_topic(bot, channel)
+    if old_nick and old_topic:
         topic = old_topic.replace('Signal: {}'.format(old_nick),
                                   'Signal: {}'.format(trigger.nick))
         set_topic(bot, channel, topic)
-        bot.reply('topic updated in {}'.format(channel))
+        reply(bot, trigger, 'topic updated in {}'.format(channel))
         #bot.write(['MODE', channel, '-o', old_nick])
     else:
-        bot.reply('Topic does not have the | Signal: <nick> | pattern?')
+        reply(bot, trigger, 'Topic does not have the | Signal: <nick> | pattern?')
 
 
 def get_conference_day(bot):
@@ -523,8 +932,15 @@ def get_conference_day(bot):
     return dayN
 
 
-def announce_scheduled_start(bot, session):
-    diff = session.date - get_now(bot)
+def format_countdown(bot, session, now=None):
+    """
+    The time dependent parts of a scheduled start announcement.
+    :return: the short format colored by urgency, the countdown in words
+    """
+    if now is None:
+        now = get_now(bot)
+
+    diff = session.date - now
     pdiff = pendulum.interval.instance(diff)
 
     seconds = pdiff.total_seconds()
@@ -538,30 +954,47 @@ def announce_scheduled_start(bot, session):
     else:
         color = sopel.formatting.colors.RED
 
-    msg = session.format_short(
-        color=color) + ' in ' + sopel.formatting.CONTROL_BOLD + pdiff.in_words() + sopel.formatting.CONTROL_NORMAL
+    return session.format_short(color=color), pdiff.in_words()
 
-    bot.msg(bot.config.c3schedule.channel, msg)
 
-    if session.room in hall_channels:
-        channel = hall_channels[session.room]
-        signal_angel = bot.memory['c3schedule_angels'].get(channel)
-        if not signal_angel:
-            signal_angel = parse_signal_angel(bot, channel)
+def announce_scheduled_starts(bot, sessions):
+    # one point in time for the whole batch, so equal start times get equal countdowns
+    now = get_now(bot)
+    announcements = [(session,) + format_countdown(bot, session, now) for session in sessions]
 
-        topic = session.format_channel_topic(bot, angel=signal_angel)
-        bot.msg(channel, msg)
-        set_topic(bot, channel, topic)
-    else:
-        logger.info('%s (%s) not in hall_channels', session.room, type(session.room))
+    # the schedule channel gets one digest per countdown
+    digests = {}
+    for session, short, countdown in announcements:
+        digests.setdefault(countdown, []).append(short)
 
-    for account in get_accounts_for_session_id(bot.db, session.id):
-        for nick in get_nicks_for_account(bot, account):
-            bot.msg(nick, msg)
+    for countdown, shorts in digests.items():
+        countdown = sopel.formatting.CONTROL_BOLD + countdown + sopel.formatting.CONTROL_NORMAL
+        if len(shorts) == 1:
+            send_message(bot, bot.config.c3schedule.channel, shorts[0] + ' in ' + countdown, PRIORITY_ANNOUNCEMENT)
+        else:
+            prefix = render_jinja(bot.config.c3schedule.digest_scheduled_start_prefix, countdown=countdown)
+            send_digest(bot, bot.config.c3schedule.channel, prefix, shorts)
+
+    for session, short, countdown in announcements:
+        msg = short + ' in ' + sopel.formatting.CONTROL_BOLD + countdown + sopel.formatting.CONTROL_NORMAL
+
+        channel = get_rooms(bot).channel_for_room(session.room)
+        if channel:
+            signal_angel = bot.memory['c3schedule_angels'].get(channel)
+            if not signal_angel:
+                signal_angel = parse_signal_angel(bot, channel)
+
+            topic = session.format_channel_topic(bot, angel=signal_angel)
+            send_message(bot, channel, msg, PRIORITY_ANNOUNCEMENT)
+            set_topic(bot, channel, topic)
+        else:
+            logger.info('%s (%s) has no hall channel', session.room, type(session.room))
+
+        send_to_many(bot, get_subscriber_nicks(bot, session.id), msg, PRIORITY_NOTIFICATION)
 
 
 def parse_signal_angel(bot, channel):
-    topic = get_topic(bot, channel)
+    topic = get_topic(bot, channel) or ''
 
     parts = [x.strip() for x in topic.split('|')]
     for part in parts:
@@ -572,30 +1005,139 @@ def parse_signal_angel(bot, channel):
     return False
 
 
-def announce_start(bot, session):
-    msg = 'NOW ' + session.format_short(color=sopel.formatting.colors.RED)
+def announce_starts(bot, sessions):
+    announcements = [(session, session.format_short(color=sopel.formatting.colors.RED)) for session in sessions]
 
-    bot.msg(bot.config.c3schedule.channel, msg)
-
-    if session.room in hall_channels:
-        bot.msg(hall_channels[session.room], msg)
+    if len(announcements) == 1:
+        send_message(bot, bot.config.c3schedule.channel, 'NOW ' + announcements[0][1], PRIORITY_ANNOUNCEMENT)
     else:
-        logger.info('%s (%s) not in hall_channels', session.room, type(session.room))
+        prefix = render_jinja(bot.config.c3schedule.digest_start_prefix)
+        send_digest(bot, bot.config.c3schedule.channel, prefix, [short for session, short in announcements])
+
+    for session, short in announcements:
+        msg = 'NOW ' + short
 
-    for account in get_accounts_for_session_id(bot.db, session.id):
-        for nick in get_nicks_for_account(bot, account):
-            bot.msg(nick, msg)
+        channel = get_rooms(bot).channel_for_room(session.room)
+        if channel:
+            send_message(bot, channel, msg, PRIORITY_ANNOUNCEMENT)
+        else:
+            logger.info('%s (%s) has no hall channel', session.room, type(session.room))
+
+        send_to_many(bot, get_subscriber_nicks(bot, session.id), msg, PRIORITY_NOTIFICATION)
+
+
+def get_subscriber_nicks(bot, session_id):
+    return [nick for account in bot.memory['c3schedule_subscriptions'].accounts(session_id)
+            for nick in get_nicks_for_account(bot, account)]
+
+
+def send_to_many(bot, targets, text, priority):
+    """
+    Sends the same text to all `targets`, putting as many of them into one PRIVMSG as
+    the server's TARGMAX and the line length allow.
+    """
+    targmax = bot.memory.get('c3schedule_targmax') or 1
+    text_length = len(text.encode('utf-8'))
 
+    chunk = []
+    for target in targets:
+        if chunk and (len(chunk) >= targmax or line_budget(bot, ','.join(chunk + [target])) < text_length):
+            send_message(bot, ','.join(chunk), text, priority)
+            chunk = []
+        chunk.append(target)
 
-@sopel.module.interval(15)
+    if chunk:
+        send_message(bot, ','.join(chunk), text, priority)
+
+
+def parse_targmax(params):
+    """
+    The number of targets a PRIVMSG may have according to the ISUPPORT `params`
+    (PRIVMSG:4 in TARGMAX or the older MAXTARGETS=4), sys.maxsize if unlimited
+    and None if not advertised.
+    """
+    for param in params:
+        name, _, value = param.partition('=')
+        if name == 'TARGMAX':
+            for limit in value.split(','):
+                command, _, count = limit.partition(':')
+                if command.upper() == 'PRIVMSG':
+                    return int(count) if count else sys.maxsize
+        elif name == 'MAXTARGETS' and value:
+            return int(value)
+
+    return None
+
+
+@sopel.module.event('005')
+@sopel.module.rule('.*')
+@sopel.module.priority('low')
 @sopel.module.unblockable
+def track_isupport(bot, trigger):
+    # ISUPPORT arrives in several lines, only the one carrying the limit matters
+    targmax = parse_targmax(trigger.args[1:-1])
+    if targmax is not None:
+        bot.memory['c3schedule_targmax'] = targmax
+
+
+# room for the ":nick!user@host " prefix the server adds to our messages
+HOSTMASK_RESERVE = 80
+
+
+def line_budget(bot, target):
+    """
+    The number of bytes of text that fit into a single PRIVMSG to `target`.
+    """
+    return 512 - len(':{} PRIVMSG {} :\r\n'.format(bot.nick, target).encode('utf-8')) - HOSTMASK_RESERVE
+
+
+def pack_lines(prefix, items, separator, max_bytes):
+    """
+    Joins `items` into as few lines starting with `prefix` as fit into `max_bytes` each.
+    """
+    lines = []
+    line = None
+
+    for item in items:
+        if line is not None and len((line + separator + item).encode('utf-8')) <= max_bytes:
+            line += separator + item
+        else:
+            if line is not None:
+                lines.append(line)
+            line = prefix + item
+
+    if line is not None:
+        lines.append(line)
+
+    return lines
+
+
+def send_digest(bot, target, prefix, items):
+    for line in pack_lines(prefix, items, bot.config.c3schedule.digest_separator, line_budget(bot, target)):
+        send_message(bot, target, line, PRIORITY_ANNOUNCEMENT)
+
+
+@sopel.module.interval(60)
+def check_day_rollover(bot):
+    if bot.memory.get('c3schedule_topic_day') != get_today(bot):
+        update_topic(bot)
+
+
 def update_topic(bot):
+    """
+    Sets the topic of the schedule channel, on schedule swaps and day rollovers.
+    """
+    if bot.memory.get('c3schedule_topics') is None:
+        # not set up
+        return
+
     dayN = get_conference_day(bot)
 
     if dayN is None:
         return
 
     schedule = bot.memory['c3schedule']
+    bot.memory['c3schedule_topic_day'] = get_today(bot)
 
     topic = render_jinja(bot.config.c3schedule.topic_template,
         acronym=schedule.conference.acronym, title=schedule.conference.title, start=schedule.conference.start,
@@ -604,112 +1146,398 @@ def update_topic(bot):
         url=render_jinja(bot.config.c3schedule.fahrplan_url, year=schedule.conference.start.year)
     )
 
-    try:
-        current_topic = get_topic(bot, bot.config.c3schedule.channel)
-    except KeyError:
-        logger.info("topic of %s not yet known. Retrying in 15s.", bot.config.c3schedule.channel)
-    else:
-        if current_topic != topic:
-            set_topic(bot, bot.config.c3schedule.channel, topic)
+    set_topic(bot, bot.config.c3schedule.channel, topic)
+
+
+class SessionChange:
+    """
+    A session that exists in both schedules but differs in `fields`.
+    """
+    __slots__ = ('old_session', 'session', 'fields')
+
+    def __init__(self, old_session, session, fields):
+        self.old_session = old_session
+        self.session = session
+        self.fields = fields
+
+    @property
+    def moved_start(self):
+        return 'date' in self.fields
+
+    @property
+    def moved_room(self):
+        return 'room' in self.fields
+
+    def describe(self):
+        parts = []
+        if self.moved_start:
+            parts.append('moved to {}'.format(self.session.date))
+        if self.moved_room:
+            parts.append('moved to {}'.format(self.session.room))
+        if 'title' in self.fields:
+            parts.append('new title')
+        if 'persons' in self.fields:
+            parts.append('speakers changed')
+        if not parts:
+            parts.append('details changed')
+
+        return ', '.join(parts)
 
 
 def diff_schedules(old_schedule, schedule):
     changed_sessions, added_sessions, missing_sessions = [], [], []
 
-    old_sessions = dict((s.id, s) for s in old_schedule.isessions())
-    sessions = dict((s.id, s) for s in schedule.isessions())
+    old_sessions = old_schedule._session_by_id
+    sessions = schedule._session_by_id
 
     for session_id, session in old_sessions.items():
         if session_id not in sessions:
             missing_sessions.append(session)
 
-
-    for session_id, session in sessions.items():
-        if session_id not in old_sessions:
-            added_sessions.append(session)
-
     for session_id, session in sessions.items():
         old_session = old_sessions.get(session_id)
-        if old_session:
-            if old_session != session:
-                changed_sessions.append(session)
+        if old_session is None:
+            added_sessions.append(session)
+        elif session is not old_session and (session.source is None or session.source != old_session.source):
+            fields = old_session.changed_fields(session)
+            if fields:
+                changed_sessions.append(SessionChange(old_session, session, fields))
 
     return changed_sessions, added_sessions, missing_sessions
 
 
+class ScheduleUpdate:
+    """
+    The outcome of a schedule refresh. It is prepared on the refreshing thread
+    and published by `publish_schedule_update` in one go.
+    """
+
+    def __init__(self, schedule, changes=None, startup=False, download=None):
+        self.schedule = schedule
+        # (changed, added, missing) or None if the sessions did not change
+        self.changes = changes
+        self.startup = startup
+        # the download the schedule came from, accepted once it is published
+        self.download = download
+
+
+# serializes refreshes triggered by the interval, .update and setup()
+_refresh_lock = threading.Lock()
+
+
+def start_refresh(bot, startup=False):
+    """
+    Refreshes the schedule in a background thread so the caller does not
+    block on the network.
+    """
+    thread = threading.Thread(target=refresh_schedule, args=(bot,), kwargs=dict(startup=startup),
+                              name='c3schedule-refresh')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+@sopel.module.interval(60)
+@sopel.module.unblockable
+def top_up_announcements(bot):
+    """
+    Keeps the announcement horizon moving, regardless of whether the
+    schedule downloads succeed.
+    """
+    schedule = bot.memory['c3schedule']
+    announcer = bot.memory.get('c3schedule_announcer')
+
+    if schedule and announcer:
+        announcer.top_up(schedule)
+
 
 @sopel.module.interval(600)
 @sopel.module.unblockable
 def refresh_schedule(bot, startup=False):
+    if not _refresh_lock.acquire(blocking=False):
+        logger.info('Schedule refresh already in progress')
+        return
+
+    try:
+        update = build_schedule_update(bot, startup=startup)
+        if update.schedule is not None:
+            publish_schedule_update(bot, update)
+            if update.download is not None:
+                get_download_task(bot).accept(update.download)
+    finally:
+        _refresh_lock.release()
+
+
+def build_schedule_update(bot, startup=False):
+    """
+    Downloads, parses and diffs the schedule.
+    Nothing in here touches the state the command handlers read.
+    """
     old_schedule = bot.memory['c3schedule']
-    old_hashsum = bot.memory.get('c3hashsum')
 
     logger.info('Downloading schedule')
-    task = ScheduleDownloadTask(render_jinja(bot.config.c3schedule.url, year=get_today(bot).year))
-    hashsum, schedule = task.run()
+    result = get_download_task(bot).run(previous=old_schedule)
+
+    changes = None
+    download = None
+    if result is NOT_MODIFIED or result is None:
+        # nothing new to parse or diff, keep the current schedule
+        schedule = old_schedule
+    else:
+        download = result
+        hashsum, schedule = download.hashsum, download.schedule
+        if old_schedule and (old_schedule.version != schedule.version or hashsum != old_schedule.hashsum):
+            changes = diff_schedules(old_schedule, schedule)
+
+        # build these here rather than in the first commands after the swap
+        schedule.search_index
+        for session in schedule.isessions():
+            session.prerender(bot)
+
+    return ScheduleUpdate(schedule, changes=changes, startup=startup, download=download)
+
+
+def publish_schedule_update(bot, update):
+    old_schedule = bot.memory['c3schedule']
+    schedule = update.schedule
+
+    # the schedule, its hashsum and its indexes are swapped in at once
+    bot.memory['c3schedule'] = schedule
+    if schedule is not old_schedule:
+        bot.memory['c3schedule_response_cache'].clear()
+
+    if update.changes:
+        changed_sessions, added_sessions, missing_sessions = update.changes
+
+        # notify subscribers about changes to their tracks
+        #for change in changed_sessions:
+        #    send_session_changed(bot, bot.config.c3schedule.channel, change)
+        #    for account in bot.memory['c3schedule_subscriptions'].accounts(change.session.id):
+        #        send_session_changed_to_account(bot, account, change)
+
+        for session in missing_sessions:
+            send_session_removed(bot, bot.config.c3schedule.channel, session)
+            for account in bot.memory['c3schedule_subscriptions'].accounts(session.id):
+                send_session_removed_to_account(bot, account, session)
+
+        if not update.startup:
+            for session in added_sessions:
+                send_session_added(bot, bot.config.c3schedule.channel, session)
+                for account in bot.memory['c3schedule_subscriptions'].accounts(session.id):
+                    send_session_added_to_account(bot, account, session)
 
     announcer = bot.memory.get('c3schedule_announcer')
 
-    if announcer:
-        announcer.stop()
+    if announcer is None:
+        announcer = bot.memory['c3schedule_announcer'] = AnnoucementScheduler(
+            bot, coalesce_window=bot.config.c3schedule.coalesce_window)
+        announcer.start()
+    elif update.changes:
+        announcer.apply_changes(*update.changes)
+    elif schedule is not old_schedule:
+        # a schedule we could not diff against, re-arm all announcements
+        announcer.clear()
 
-    if old_schedule and schedule:
-        if old_schedule.version != schedule.version or hashsum != old_hashsum:
-            changed_sessions, added_sessions, missing_sessions = diff_schedules(old_schedule, schedule)
+    announcer.top_up(schedule)
 
-            # notify subscribers about changes to their tracks
-            #for session in changed_sessions:
-            #    send_session_changed(bot, bot.config.c3schedule.channel, session)
-            #    for account in get_accounts_for_session_id(bot.db, session.id):
-            #        send_session_changed_to_account(bot, account, session)
+    logger.info('%d announcements pending', announcer.pending)
 
-            for session in missing_sessions:
-                send_session_removed(bot, bot.config.c3schedule.channel, session)
-                for account in get_accounts_for_session_id(bot.db, session.id):
-                    send_session_removed_to_account(bot, account, session)
+    if schedule is not old_schedule:
+        update_topic(bot)
 
-            if not startup:
-                for session in added_sessions:
-                    send_session_added(bot, bot.config.c3schedule.channel, session)
-                    for account in get_accounts_for_session_id(bot.db, session.id):
-                        send_session_added_to_account(bot, account, session)
 
-    if schedule is None:
-        schedule = old_schedule
+def get_snapshot_path(bot):
+    if not bot.config.c3schedule.snapshot_file:
+        return None
 
-    bot.memory['c3schedule'] = schedule
-    bot.memory['c3hashsum'] = hashsum
+    return os.path.join(bot.config.core.homedir, bot.config.c3schedule.snapshot_file)
 
-    if schedule:
-        announcer = bot.memory['c3schedule_announcer'] = AnnoucementScheduler(bot)
-        # try to schedule all sessions within the next hour seconds
-        future = get_now(bot) + datetime.timedelta(hours=1)
-        for day in schedule.conference.days:
-            for room_name, room in day.rooms.items():
-                for session in room.sessions.values():
-                    if session.date < future:
-                        announcer.add(session)
+
+def load_snapshot(bot):
+    """
+    Publishes the schedule from the last snapshot (if any) so the bot can answer
+    while the first download is still running or the Fahrplan is unreachable.
+    """
+    path = get_snapshot_path(bot)
+    if path is None:
+        return
+
+    # the validators are only good for the url they were sent by
+    snapshot = load_schedule_snapshot(path, url=get_schedule_url(bot))
+    if snapshot is None:
+        return
+
+    schedule, etag, last_modified = snapshot
+    logger.info('Loaded schedule %s (%s) from snapshot %s', schedule.version, schedule.hashsum, path)
+    publish_schedule_update(bot, ScheduleUpdate(schedule, startup=True))
+
+    task = get_download_task(bot)
+    task.etag = etag
+    task.last_modified = last_modified
+
+
+SNAPSHOT_MAGIC = b'c3schedule-snapshot'
+SNAPSHOT_VERSION = 2
+
+
+def save_schedule_snapshot(path, content, hashsum, etag=None, last_modified=None, url=None):
+    """
+    Stores the raw schedule document compressed along with its hashsum, the url
+    it was downloaded from and its cache validators. The file is replaced atomically.
+    """
+    header = json.dumps(dict(version=SNAPSHOT_VERSION, hashsum=hashsum, etag=etag, last_modified=last_modified,
+                             url=url))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        fh.write(SNAPSHOT_MAGIC + b'\n')
+        fh.write(header.encode('utf-8') + b'\n')
+        fh.write(zlib.compress(content))
+    os.replace(tmp_path, path)
+
+
+def load_schedule_snapshot(path, url=None):
+    """
+    Loads a snapshot written by `save_schedule_snapshot`.
+    :param url: if given, snapshots downloaded from another url are ignored
+    :return: (schedule, etag, last_modified) or None if there is no usable snapshot
+    """
+    try:
+        with open(path, 'rb') as fh:
+            magic = fh.readline().rstrip(b'\n')
+            header = json.loads(fh.readline().decode('utf-8'))
+            content = zlib.decompress(fh.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, zlib.error) as e:
+        logger.warning('Ignoring unreadable schedule snapshot %s: %s', path, e)
+        return None
+
+    if magic != SNAPSHOT_MAGIC or not isinstance(header, dict) or header.get('version') != SNAPSHOT_VERSION:
+        logger.warning('Ignoring schedule snapshot %s with unknown format', path)
+        return None
+
+    if url is not None and header.get('url') != url:
+        logger.info('Ignoring schedule snapshot %s of %s', path, header.get('url'))
+        return None
+
+    hashsum = hashlib.md5(content).hexdigest()
+    if hashsum != header.get('hashsum'):
+        logger.warning('Ignoring corrupt schedule snapshot %s', path)
+        return None
+
+    try:
+        schedule = Schedule.from_json(json.loads(content.decode('utf-8'))['schedule'], hashsum=hashsum)
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+        logger.warning('Ignoring schedule snapshot %s that does not parse', path)
+        logger.exception(e)
+        return None
+
+    return schedule, header.get('etag'), header.get('last_modified')
+
+
+def get_schedule_url(bot):
+    return render_jinja(bot.config.c3schedule.url, year=get_today(bot).year)
+
+
+def get_download_task(bot):
+    """
+    Returns the download task for the configured schedule url, keeping it (and
+    with it the HTTP connection pool and the cache validators) across refreshes.
+    """
+    url = get_schedule_url(bot)
+    task = bot.memory.get('c3schedule_download_task')
+    if task is None or task.url != url:
+        # only skip parsing identical content if we still hold the schedule it produced
+        schedule = bot.memory['c3schedule']
+        hashsum = schedule.hashsum if schedule else None
+        task = bot.memory['c3schedule_download_task'] = ScheduleDownloadTask(url, hashsum=hashsum,
+                                                                             snapshot_path=get_snapshot_path(bot))
+
+    return task
 
 
 def get_nicks_for_account(bot, account):
-    for user in bot.users.values():
-        if user.account == account:
-            yield user.nick
+    return bot.memory['c3schedule_accounts'].nicks(account)
+
+
+# The account index follows the events coretasks uses to maintain bot.users. Our handlers
+# run at low priority and unthreaded, i.e. after coretasks' unthreaded ones have been applied.
+# Account changes are taken from the message itself since coretasks applies those in a thread.
+
+@sopel.module.event('ACCOUNT')
+@sopel.module.rule('.*')
+@sopel.module.priority('low')
+@sopel.module.thread(False)
+@sopel.module.unblockable
+def track_account(bot, trigger):
+    account = trigger.args[0]
+    bot.memory['c3schedule_accounts'].set(trigger.nick, None if account == '*' else account)
+
+
+@sopel.module.event('JOIN')
+@sopel.module.rule('.*')
+@sopel.module.priority('low')
+@sopel.module.thread(False)
+@sopel.module.unblockable
+def track_account_join(bot, trigger):
+    # extended-join carries the account, otherwise it arrives with the WHOX reply
+    if len(trigger.args) > 1:
+        account = trigger.args[1]
+        bot.memory['c3schedule_accounts'].set(trigger.nick, None if account == '*' else account)
+
+
+@sopel.module.event('354')
+@sopel.module.rule('.*')
+@sopel.module.priority('low')
+@sopel.module.thread(False)
+@sopel.module.unblockable
+def track_account_whox(bot, trigger):
+    # the reply to coretasks' WHO <channel> a%nuachtf
+    if len(trigger.args) != 8:
+        return
+
+    nick, account = trigger.args[5], trigger.args[7]
+    bot.memory['c3schedule_accounts'].set(Identifier(nick), None if account == '0' else account)
+
+
+@sopel.module.event('NICK')
+@sopel.module.rule('.*')
+@sopel.module.priority('low')
+@sopel.module.thread(False)
+@sopel.module.unblockable
+def track_account_nick(bot, trigger):
+    bot.memory['c3schedule_accounts'].rename(trigger.nick, Identifier(trigger.args[0]))
+
+
+@sopel.module.event('PART', 'KICK', 'QUIT')
+@sopel.module.rule('.*')
+@sopel.module.priority('low')
+@sopel.module.thread(False)
+@sopel.module.unblockable
+def track_account_leave(bot, trigger):
+    nick = Identifier(trigger.args[1]) if trigger.event == 'KICK' else trigger.nick
+    if nick == bot.nick:
+        # we left a channel and coretasks dropped everyone we no longer share one with
+        bot.memory['c3schedule_accounts'] = AccountIndex.from_users(bot.users)
+    elif nick not in bot.users:
+        bot.memory['c3schedule_accounts'].discard(nick)
 
 
-def send_session_changed_to_account(bot, account, session):
+def send_session_changed_to_account(bot, account, change):
     for nick in get_nicks_for_account(bot, account):
-        send_session_changed(bot, nick, session)
+        send_session_changed(bot, nick, change)
 
 
-def send_session_changed(bot, to, session):
+def send_session_changed(bot, to, change):
+    session = change.session
     title = session.title
     id = session.id
     url = session.url(bot)
 
-    bot.msg(to, 'The session \'{title}\' ({id}) has been changed. Please check the website for details: {url}'.format(
-        title=title, id=id, url=url
-    ))
+    send_message(bot, to, 'The session \'{title}\' ({id}) has been changed ({changes}). Please check the website for details: {url}'.format(
+        title=title, id=id, changes=change.describe(), url=url
+    ), PRIORITY_NOTIFICATION)
 
 
 def send_session_removed_to_account(bot, account, session):
@@ -718,10 +1546,10 @@ def send_session_removed_to_account(bot, account, session):
 
 
 def send_session_removed(bot, to, session):
-    bot.msg(to,
+    send_message(bot, to,
             'The session \'{title}\' ({id}) has been removed. In case it re-appears you\'ll be subscribed again.'.format(
                 title=session.title, id=session.id
-            ))
+            ), PRIORITY_NOTIFICATION)
 
 
 def send_session_added_to_account(bot, account, session):
@@ -730,16 +1558,21 @@ def send_session_added_to_account(bot, account, session):
 
 
 def send_session_added(bot, to, session):
-    bot.msg(to,
+    send_message(bot, to,
             'The session \'{title}\' ({id}) has been added. You receive this notification since you might have subscribed to this session in the past.'.format(
                 title=session.title, id=session.id
-            ))
+            ), PRIORITY_NOTIFICATION)
 
 
 def parse_date(s):
     return pendulum.Date.instance(datetime.datetime.strptime(s, '%Y-%m-%d').date())
 
 
+# sessions share most of their dates and durations, parse each string only once
+PARSE_CACHE_SIZE = 8192
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
 def parse_duration(s):
     parts = s.split(':')
     days = 0
@@ -751,11 +1584,49 @@ def parse_duration(s):
     return pendulum.Interval.instance(datetime.timedelta(days=int(days), hours=int(hours), minutes=int(minutes)))
 
 
+# the format frab uses for all timestamps, e.g. 2016-12-27T11:00:00+01:00
+ISO_8601_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?'
+                         r'(?:(Z)|([+-])(\d{2}):?(\d{2}))?$')
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
 def parse_day(s):
-    return pendulum.Pendulum.instance(dateutil.parser.parse(s))
+    match = ISO_8601_RE.match(s)
+    if match is None:
+        return pendulum.Pendulum.instance(dateutil.parser.parse(s))
+
+    year, month, day, hour, minute, second, fraction, utc, sign, offset_hours, offset_minutes = match.groups()
+
+    if sign:
+        tz = int(offset_hours) + int(offset_minutes) / 60
+        if sign == '-':
+            tz = -tz
+    elif utc:
+        tz = 0.0
+    else:
+        # naive timestamps are treated as UTC, just like Pendulum.instance does
+        tz = pendulum.UTC
+
+    return pendulum.Pendulum(int(year), int(month), int(day), int(hour), int(minute), int(second or 0),
+                             int((fraction or '0').ljust(6, '0')), tzinfo=tz)
+
+
+def intern(s):
+    """
+    Interns low-cardinality strings (rooms, tracks, languages, ...) so all
+    sessions share a single copy.
+    """
+    if isinstance(s, str):
+        return sys.intern(s)
+    return s
 
 
 class Person:
+    __slots__ = ('id', 'public_name', '__weakref__')
+
+    # one instance per speaker, shared by all of their sessions in all schedules in memory
+    _instances = weakref.WeakValueDictionary()
+
     def __init__(self, id, full_public_name):
         self.id = id
         self.public_name = full_public_name
@@ -765,12 +1636,26 @@ class Person:
 
     @classmethod
     def from_json(cls, person_json):
-        return Person(person_json['id'], person_json.get('full_public_name', person_json.get('public_name', person_json.get('name', 'N/A'))))
+        id = person_json['id']
+        public_name = person_json.get('full_public_name', person_json.get('public_name', person_json.get('name', 'N/A')))
+
+        key = (id, public_name)
+        person = cls._instances.get(key)
+        if person is None:
+            person = cls._instances.setdefault(key, cls(id, public_name))
+        return person
 
 
 class Session:
+    FIELDS = ('id', 'guid', 'logo', 'date', 'start', 'duration', 'room', 'slug', 'title', 'subtitle', 'track',
+              'type', 'language', 'abstract', 'description', 'recording_license', 'do_not_record', 'persons',
+              'links', 'attachments')
+
+    __slots__ = FIELDS + ('source', 'rendered')
+
     def __init__(self, id, guid, logo, date, start, duration, room, slug, title, subtitle, track, type, language,
-                 abstract, description, recording_license, do_not_record, persons, links, attachments):
+                 abstract, description, recording_license, do_not_record, persons, links, attachments,
+                 source=None):
         self.id = id
         self.guid = guid
         self.logo = logo
@@ -791,14 +1676,23 @@ class Session:
         self.persons = persons
         self.links = links
         self.attachments = attachments
+        # the session's JSON, equal sources imply equal sessions
+        self.source = source
+        # cached renderings, a session whose source changes is a new object with an empty cache
+        self.rendered = None
 
     def __eq__(self, other):
+        if self.source is not None and self.source == other.source:
+            return True
 
-        for key, value in self.__dict__.items():
-            if value != getattr(other, key):
+        for key in self.FIELDS:
+            if getattr(self, key) != getattr(other, key):
                 return False
 
         return True
+
+    def changed_fields(self, other):
+        return tuple(key for key in self.FIELDS if getattr(self, key) != getattr(other, key))
         #
         # return self.id == other.id and self.guid == other.guid and self.logo == other.logo and self.date == other.date and self.start == other.start \
         #        and self.duration == other.duration and self.room == other.room and self.slug == other.slug and self.title == other.title \
@@ -816,20 +1710,21 @@ class Session:
                    parse_day(session_json['date']),
                    parse_duration(session_json['start']),
                    parse_duration(session_json['duration']),
-                   session_json['room'],
+                   intern(session_json['room']),
                    session_json['slug'],
                    session_json['title'],
                    session_json['subtitle'],
-                   session_json['track'],
-                   session_json['type'],
-                   session_json['language'],
+                   intern(session_json['track']),
+                   intern(session_json['type']),
+                   intern(session_json['language']),
                    session_json['abstract'],
                    session_json['description'],
-                   session_json.get('recording_license', ''),
+                   intern(session_json.get('recording_license', '')),
                    session_json.get('do_not_record', False),
                    [Person.from_json(p) for p in session_json.get('persons', [])],
                    session_json.get('links', []),
-                   session_json.get('attachments', []))
+                   session_json.get('attachments', []),
+                   source=session_json)
 
     def _format_track(self):
         if self.track:
@@ -840,50 +1735,69 @@ class Session:
         return track
 
 
-    def format_summary(self, color=None):
-        date = str(self.date)
-        if color:
-            date = sopel.formatting.color(date, fg=color)
+    def _rendered(self, key, render, *args):
+        rendered = self.rendered
+        if rendered is None:
+            rendered = self.rendered = {}
 
-        title = self.title
+        value = rendered.get(key)
+        if value is None:
+            value = rendered[key] = render(*args)
+        return value
 
+    def prerender(self, bot):
+        """
+        Renders everything that does not depend on the time of the request.
+        """
+        self._rendered('summary', self._render_summary)
+        self._rendered('short', self._render_short)
+        self.url(bot)
 
+    # stands in for the parts rendered at request time
+    PLACEHOLDER = '\0'
+
+    def _render_summary(self):
         return '[{room}] {date} ({duration}) ‒ [{language}/{type}{track}] {bold}{title}{normal} / {persons} ({id})'.format(
             language=self.language,
             type=self.type,
             room=self.room,
-            date=date,
-            title=title,
+            date=self.PLACEHOLDER,
+            title=self.title,
             duration=self.duration,
             track=self._format_track(),
-            persons=', '.join([p.public_name for p in self.persons]),
+            persons=', '.join([p.public_name or '' for p in self.persons]),
             bold=sopel.formatting.CONTROL_BOLD,
             normal=sopel.formatting.CONTROL_NORMAL,
             id=self.id
-        )
+        ).partition(self.PLACEHOLDER)
 
+    def format_summary(self, color=None):
+        date = str(self.date)
+        if color:
+            date = sopel.formatting.color(date, fg=color)
 
+        before, _, after = self._rendered('summary', self._render_summary)
+        return before + date + after
 
     def format_channel_topic(self, bot, angel=None):
+        config = bot.config.c3schedule
+        key = (config.channel_topic_template, config.channel_topic_suffix, config.stream_url_template,
+               config.session_url, config.rooms, angel)
+
+        if self.rendered is None:
+            self.rendered = {}
+
+        # only the latest topic is kept, the angel changes every now and then
+        cached = self.rendered.get('topic')
+        if cached is None or cached[0] != key:
+            cached = self.rendered['topic'] = (key, self._render_channel_topic(bot, angel))
+        return cached[1]
+
+    def _render_channel_topic(self, bot, angel):
         template = bot.config.c3schedule.channel_topic_template
         suffix_template = bot.config.c3schedule.channel_topic_suffix
         stream_url_template = bot.config.c3schedule.stream_url_template
-        stream_hall = {
-                "rC1": "one",
-                "rC2": "two",
-                "OIO/A:F Bühne": "oio",
-                "XHain Berlin": "xhain",
-                "Wikipaka Meetups": "wikipaka",
-                "r3s - Monheim/Rhein": "r3s",
-                "hacc München / about:future": "hacc",
-                "Chaos-West TV": "cwtv",
-                "ChaosZone TV Stream": "chaoszone",
-                "ChaosZone TV": "chaoszone",
-                "Bitwäscherei Zürich": "bitwaescherei",
-                "SZ Bühne": "sendezentrum",
-                "franconian.net": "franconiannet",
-                "c-base Berlin": "cbase",
-        }.get(self.room, self.room)
+        stream_hall = get_rooms(bot).stream_for_room(self.room)
         logger.info('Room: %s Stream Hall: %s', self.room, stream_hall)
         kwargs = dict(session=self, angel=angel, bot=bot, stream_hall=stream_hall)
         stream_url = render_jinja(stream_url_template, **kwargs)
@@ -895,28 +1809,33 @@ class Session:
         )
         return topic
 
-    def format_short(self, color=None):
-        hour = '{:02}:{:02}'.format(self.date.hour, self.date.minute)
-        if color:
-            hour = sopel.formatting.color(hour, fg=color)
-
-        title = self.title
-
+    def _render_short(self):
         return '[{room}] {hour} ({duration}) - [{language}/{type}{track}] {bold}{title}{normal} / {persons} ({id})'.format(
             language=self.language,
             type=self.type,
             room=self.room,
-            hour=hour,
-            title=title,
+            hour=self.PLACEHOLDER,
+            title=self.title,
             duration=self.duration,
             track=self._format_track(),
-            persons=', '.join([p.public_name for p in self.persons]),
+            persons=', '.join([p.public_name or '' for p in self.persons]),
             bold=sopel.formatting.CONTROL_BOLD,
             normal=sopel.formatting.CONTROL_NORMAL,
             id=self.id
-        )
+        ).partition(self.PLACEHOLDER)
+
+    def format_short(self, color=None):
+        hour = '{:02}:{:02}'.format(self.date.hour, self.date.minute)
+        if color:
+            hour = sopel.formatting.color(hour, fg=color)
+
+        before, _, after = self._rendered('short', self._render_short)
+        return before + hour + after
 
     def url(self, bot):
+        return self._rendered(('url', bot.config.c3schedule.session_url), self._render_url, bot)
+
+    def _render_url(self, bot):
         if self.track != 'self organized sessions':
             return render_jinja(bot.config.c3schedule.session_url, year=self.date.year, id=self.id, type=self.type, title=self.title, slug=self.slug, links=self.links, guid=self.guid)
         else:
@@ -926,16 +1845,27 @@ class Session:
 
 
 class Room:
+    __slots__ = ('name', 'sessions')
+
     def __init__(self, name, sessions):
         self.name = name
         self.sessions = sessions
 
     @classmethod
-    def from_json(cls, name, room_json):
-        return cls(name, dict((session['id'], Session.from_json(session)) for session in room_json))
+    def from_json(cls, name, room_json, patch=None, previous=None):
+        if patch is None:
+            return cls(intern(name), dict((session['id'], Session.from_json(session)) for session in room_json))
+
+        sessions = dict((session['id'], patch.session(session)) for session in room_json)
+        if previous is not None and same_items(previous.sessions, sessions):
+            return previous
+
+        return cls(intern(name), sessions)
 
 
 class Day:
+    __slots__ = ('index', 'date', 'day_start', 'day_end', 'rooms')
+
     def __init__(self, index, date, day_start, day_end, rooms):
         self.index = index
         self.date = date
@@ -944,13 +1874,22 @@ class Day:
         self.rooms = rooms
 
     @classmethod
-    def from_json(cls, day_json):
-        return cls(day_json['index'],
-                   parse_date(day_json['date']),
-                   parse_day(day_json['day_start']),
-                   parse_day(day_json['day_end']),
-                   dict((name, Room.from_json(name, room)) for name, room in day_json['rooms'].items())
-                   )
+    def from_json(cls, day_json, patch=None, previous=None):
+        previous_rooms = previous.rooms if previous is not None else {}
+        day = cls(day_json['index'],
+                  parse_date(day_json['date']),
+                  parse_day(day_json['day_start']),
+                  parse_day(day_json['day_end']),
+                  dict((intern(name), Room.from_json(name, room, patch=patch, previous=previous_rooms.get(name)))
+                       for name, room in day_json['rooms'].items())
+                  )
+
+        if previous is not None and same_items(previous.rooms, day.rooms) and \
+                (previous.index, previous.date, previous.day_start, previous.day_end) == \
+                (day.index, day.date, day.day_start, day.day_end):
+            return previous
+
+        return day
 
 
 class Conference:
@@ -964,25 +1903,270 @@ class Conference:
         self.days = days
 
     @classmethod
-    def from_json(cls, conference_json):
+    def from_json(cls, conference_json, patch=None, previous=None):
+        previous_days = dict((day.index, day) for day in previous.days) if previous is not None else {}
         return cls(conference_json['acronym'],
                    conference_json['title'],
                    parse_date(conference_json['start']),
                    parse_date(conference_json['end']),
                    conference_json['daysCount'],
                    parse_duration(conference_json['timeslot_duration']),
-                   [Day.from_json(day) for day in conference_json['days']]
+                   [Day.from_json(day, patch=patch, previous=previous_days.get(day['index']))
+                    for day in conference_json['days']]
                    )
 
 
+def same_items(old, new):
+    """
+    True if both dicts map the same keys to the very same objects.
+    """
+    return len(old) == len(new) and all(old.get(key) is value for key, value in new.items())
+
+
+class SchedulePatch:
+    """
+    Hands out the sessions of the previous schedule for every session JSON
+    that did not change and keeps track of what had to be rebuilt.
+    """
+
+    def __init__(self, previous):
+        self.previous = previous
+        self.seen = set()
+        self.rebuilt = []
+        self.reused = 0
+
+    def session(self, session_json):
+        self.seen.add(session_json['id'])
+
+        # comparing the decoded JSON stops at the first difference, no need to serialize or hash it
+        previous = self.previous.get_session(session_json['id'])
+        if previous is not None and previous.source == session_json:
+            self.reused += 1
+            return previous
+
+        session = Session.from_json(session_json)
+        self.rebuilt.append(session)
+        return session
+
+    def removed(self):
+        """
+        The sessions of the previous schedule that are gone or were rebuilt.
+        """
+        previous = self.previous._session_by_id
+        removed = [previous[session_id] for session_id in previous.keys() - self.seen]
+        removed.extend(previous[session.id] for session in self.rebuilt if session.id in previous)
+        return removed
+
+    def session_by_id(self):
+        session_by_id = dict(self.previous._session_by_id)
+        for session_id in session_by_id.keys() - self.seen:
+            del session_by_id[session_id]
+        for session in self.rebuilt:
+            session_by_id[session.id] = session
+
+        return session_by_id
+
+
+def iter_bits(bits):
+    """
+    The positions of the set bits, lowest first.
+    """
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+class SearchIndex:
+    """
+    Inverted index over the text of a schedule's sessions. Query tokens of
+    MIN_PREFIX_LENGTH or more match as a prefix, all tokens have to match and
+    title hits rank above speaker, abstract and description hits.
+
+    Postings refer to sessions by id, so the index of a patched schedule can
+    be derived from the previous one, see `patch`.
+    """
+    # each weight outranks all the lower ones together
+    FIELD_WEIGHTS = (('title', 16), ('persons', 8), ('subtitle', 4), ('abstract', 2), ('description', 1))
+    TOKEN_RE = re.compile(r'\w+')
+    DO_NOT_RECORD = 'do_not_record'
+    # shorter query tokens only match whole words, as a prefix they would cover most of the index
+    MIN_PREFIX_LENGTH = 3
+
+    def __init__(self, sessions=()):
+        self._postings = {}
+        self._do_not_record = set()
+
+        for session in sessions:
+            for token, weight in self._weights(session).items():
+                self._postings.setdefault(token, {})[session.id] = weight
+
+            if session.do_not_record:
+                self._do_not_record.add(session.id)
+
+        self._tokens = sorted(self._postings)
+
+    @classmethod
+    def tokenize(cls, text):
+        return cls.TOKEN_RE.findall(str(text).lower())
+
+    @classmethod
+    def _weights(cls, session):
+        """
+        :return: token -> weight of `session`
+        """
+        weights = {}
+        for field, weight in cls.FIELD_WEIGHTS:
+            if field == 'persons':
+                text = ' '.join(person.public_name or '' for person in session.persons)
+            else:
+                text = getattr(session, field) or ''
+
+            # a token counts once per field
+            for token in set(cls.tokenize(text)):
+                weights[token] = weights.get(token, 0) + weight
+
+        return weights
+
+    def patch(self, removed, added):
+        """
+        The index without the sessions `removed` and with the sessions `added`.
+        Only the postings of their tokens are copied, all others are shared
+        with this index.
+        """
+        index = SearchIndex()
+        postings = index._postings = dict(self._postings)
+        copied = set()
+
+        def posting(token):
+            if token not in copied:
+                copied.add(token)
+                postings[token] = dict(postings.get(token, ()))
+            return postings[token]
+
+        for session in removed:
+            for token in self._weights(session):
+                posting(token).pop(session.id, None)
+
+        for session in added:
+            for token, weight in self._weights(session).items():
+                posting(token)[session.id] = weight
+
+        tokens = self._tokens
+        for token in copied:
+            if not postings[token]:
+                del postings[token]
+
+            if (token in postings) != (token in self._postings):
+                if tokens is self._tokens:
+                    tokens = list(tokens)
+                position = bisect.bisect_left(tokens, token)
+                if token in postings:
+                    tokens.insert(position, token)
+                else:
+                    del tokens[position]
+        index._tokens = tokens
+
+        index._do_not_record = set(self._do_not_record)
+        index._do_not_record.difference_update(session.id for session in removed)
+        index._do_not_record.update(session.id for session in added if session.do_not_record)
+
+        return index
+
+    @staticmethod
+    def _masked(postings, allowed):
+        """
+        :param allowed: set of session ids to keep, None for all of them
+        :return: the (session id, weight) pairs of `postings` within `allowed`
+        """
+        if allowed is None:
+            return postings.items()
+        if len(allowed) < len(postings):
+            return [(session_id, postings[session_id]) for session_id in allowed if session_id in postings]
+        return [(session_id, weight) for session_id, weight in postings.items() if session_id in allowed]
+
+    def _prefix_matches(self, prefix, allowed=None):
+        """
+        :param allowed: set of session ids to consider, None for all of them
+        :return: session id -> weight of the sessions containing a token starting with `prefix`
+        """
+        if len(prefix) < self.MIN_PREFIX_LENGTH:
+            return dict((session_id, weight * 2 + 1)
+                        for session_id, weight in self._masked(self._postings.get(prefix, {}), allowed))
+
+        matches = {}
+        for position in range(bisect.bisect_left(self._tokens, prefix), len(self._tokens)):
+            token = self._tokens[position]
+            if not token.startswith(prefix):
+                break
+
+            # whole word hits rank above prefix hits
+            bonus = 1 if token == prefix else 0
+            for session_id, weight in self._masked(self._postings[token], allowed):
+                matches[session_id] = max(matches.get(session_id, 0), weight * 2 + bonus)
+
+        return matches
+
+    def has_terms(self, query):
+        return bool(self.tokenize(query))
+
+    def search(self, query, order, allowed=None, limit=None):
+        """
+        :param order: session id -> its position among equally good matches
+        :param allowed: set of the session ids to consider, None for all of them
+        :param limit: the most session ids to return, None for all of them
+        :return: the matching session ids, best match first
+        """
+        tokens = self.tokenize(query)
+        if self.DO_NOT_RECORD in tokens:
+            allowed = self._do_not_record if allowed is None else allowed & self._do_not_record
+        tokens = [token for token in dict.fromkeys(tokens) if token != self.DO_NOT_RECORD]
+
+        if not tokens:
+            scores = dict.fromkeys(allowed or (), 0)
+        else:
+            # start with the rarest token to keep the intersection small
+            matches = sorted((self._prefix_matches(token, allowed) for token in tokens), key=len)
+            scores = matches[0]
+            for match in matches[1:]:
+                scores = dict((session_id, score + match[session_id])
+                              for session_id, score in scores.items() if session_id in match)
+
+        rank = lambda session_id: (-scores[session_id], order(session_id))
+        if limit is None:
+            return sorted(scores, key=rank)
+        return heapq.nsmallest(limit, scores, key=rank)
+
+
 class Schedule:
-    def __init__(self, version, conference):
+    def __init__(self, version, conference, hashsum=None, patch=None):
+        """
+        :param patch: the SchedulePatch `conference` was built with, the indexes
+            are then derived from those of the previous schedule
+        """
         self.version = version
         self.conference = conference
+        self.hashsum = hashsum
 
-        self._session_by_id = {}
+        self._search_index = None
+        self._search_index_lock = threading.Lock()
+        # facet masks are computed on first use, see facet_mask
+        self._facet_masks = {}
+
+        if patch is None:
+            self._hash_sessions()
+            self._index_start_times()
+            self._index_facets()
+        else:
+            previous, removed, added = patch.previous, patch.removed(), patch.rebuilt
+            self._session_by_id = patch.session_by_id()
+            self._patch_start_times(previous, removed, added)
+            self._patch_facets(previous, removed, added)
+            if previous._search_index is not None:
+                self._search_index = previous._search_index.patch(removed, added)
 
-        self._hash_sessions()
+        self._index_days(patch.previous if patch is not None else None)
+        self._all_sessions = (1 << len(self._sessions_by_start)) - 1
 
     def _hash_sessions(self):
         self._session_by_id = {}
@@ -990,9 +2174,168 @@ class Schedule:
         for session in self.isessions():
             self._session_by_id[session.id] = session
 
+    @staticmethod
+    def _start_key(session):
+        return session.date.timestamp(), session.room, session.id
+
+    def _index_start_times(self):
+        sessions = sorted(self._session_by_id.values(), key=self._start_key)
+
+        self._sessions_by_start = sessions
+        self._start_times = [session.date.timestamp() for session in sessions]
+        self._start_position = dict((session.id, position) for position, session in enumerate(sessions))
+        # bounds how far back running_sessions has to look
+        self._max_duration = max((session.duration.total_seconds() for session in sessions), default=0)
+
+    def _patch_start_times(self, previous, removed, added):
+        """
+        The start order of `previous` with the sessions `removed` taken out and
+        `added` inserted where they belong.
+        """
+        sessions = list(previous._sessions_by_start)
+        start_times = list(previous._start_times)
+        start_position = dict(previous._start_position)
+
+        positions = sorted((previous._start_position[session.id] for session in removed), reverse=True)
+        for position in positions:
+            del sessions[position]
+            del start_times[position]
+        for session in removed:
+            del start_position[session.id]
+
+        touched = positions
+        for session in added:
+            key = self._start_key(session)
+            position = bisect.bisect_left(start_times, key[0])
+            while position < len(sessions) and self._start_key(sessions[position]) < key:
+                position += 1
+            sessions.insert(position, session)
+            start_times.insert(position, key[0])
+            touched.append(position)
+
+        if touched:
+            # positions only move between the first and the last change unless the number of sessions
+            # changed, later insertions can push an inserted session up by one each
+            last = len(sessions) if len(removed) != len(added) else min(len(sessions), max(touched) + len(added) + 1)
+            for position in range(min(touched), last):
+                start_position[sessions[position].id] = position
+
+        self._sessions_by_start = sessions
+        self._start_times = start_times
+        self._start_position = start_position
+
+        durations = [session.duration.total_seconds() for session in added]
+        if any(session.duration.total_seconds() >= previous._max_duration for session in removed):
+            self._max_duration = max((session.duration.total_seconds() for session in sessions), default=0)
+        else:
+            self._max_duration = max([previous._max_duration] + durations)
+
+    # facet -> session attribute
+    FACETS = {'room': 'room', 'track': 'track', 'lang': 'language', 'type': 'type'}
+
+    @classmethod
+    def _facet_values(cls, session):
+        """
+        The (facet, lowercased value) pairs `session` is indexed by, days aside.
+        """
+        for facet, attribute in cls.FACETS.items():
+            value = getattr(session, attribute)
+            if value:
+                yield facet, value.lower()
+        for person in session.persons:
+            if person.public_name:
+                yield 'speaker', person.public_name.lower()
+
+    def _index_facets(self):
+        """
+        The ids of the sessions per lowercased facet value, speakers by name.
+        """
+        self._facets = dict((facet, {}) for facet in tuple(self.FACETS) + ('speaker',))
+
+        for session in self._sessions_by_start:
+            for facet, value in self._facet_values(session):
+                self._facets[facet].setdefault(value, set()).add(session.id)
+
+    def _patch_facets(self, previous, removed, added):
+        """
+        The facets of `previous`, only the values of the sessions `removed` and
+        `added` are copied and changed.
+        """
+        self._facets = dict((facet, dict(values)) for facet, values in previous._facets.items() if facet != 'day')
+        copied = set()
+
+        def session_ids(facet, value):
+            values = self._facets[facet]
+            if (facet, value) not in copied:
+                copied.add((facet, value))
+                values[value] = set(values.get(value, ()))
+            return values[value]
+
+        for session in removed:
+            for facet, value in self._facet_values(session):
+                session_ids(facet, value).discard(session.id)
+        for session in added:
+            for facet, value in self._facet_values(session):
+                session_ids(facet, value).add(session.id)
+
+        for facet, value in copied:
+            if not self._facets[facet][value]:
+                del self._facets[facet][value]
+
+    def _index_days(self, previous=None):
+        """
+        Days are indexed by their conference day (1 is the first day, as in the
+        topic) and their date. Days shared with `previous` keep their sessions.
+        """
+        # the days of previous are alive, so their ids are not reused
+        previous_days = dict((id(day), session_ids) for day, session_ids in previous._days) if previous else {}
+
+        self._days = []
+        self._facets['day'] = {}
+        for day in self.conference.days:
+            session_ids = previous_days.get(id(day))
+            if session_ids is None:
+                session_ids = frozenset(session.id for room in day.rooms.values() for session in room.sessions.values())
+            self._days.append((day, session_ids))
+
+            day_number = str((day.date - self.conference.start).days + 1)
+            self._facets['day'][day_number] = self._facets['day'][day.date.isoformat()] = session_ids
+
+    def facet_mask(self, facet, value):
+        """
+        :param facet: room, track, lang, type, speaker or day (its number or its date, 2042-02-03)
+        :return: the bitset over the start order of sessions with that value
+        """
+        key = (facet, value.lower())
+        mask = self._facet_masks.get(key)
+        if mask is None:
+            mask = 0
+            for session_id in self._facets[facet].get(key[1], ()):
+                mask |= 1 << self._start_position[session_id]
+            self._facet_masks[key] = mask
+        return mask
+
+    def starting_after_mask(self, time):
+        return self._all_sessions & ~((1 << bisect.bisect_left(self._start_times, time.timestamp())) - 1)
+
+    def sessions_for_mask(self, mask):
+        return [self._sessions_by_start[ordinal] for ordinal in iter_bits(mask)]
+
     def get_session(self, session_id):
         return self._session_by_id.get(session_id)
 
+    def sessions_by_track(self, track):
+        return self.sessions_for_mask(self.facet_mask('track', track))
+
+    def sessions_by_speaker(self, name):
+        return self.sessions_for_mask(self.facet_mask('speaker', name))
+
+    def sessions_by_day(self, day):
+        """
+        :param day: the conference day, 1 for the first, or its date (2042-02-03)
+        """
+        return self.sessions_for_mask(self.facet_mask('day', day))
+
     def get_sessions(self, session_ids):
         l = []
         for session_id in session_ids:
@@ -1000,7 +2343,45 @@ class Schedule:
             if s:
                 l.append(s)
 
-        return sorted(l, key=lambda session: session.date)
+        return sorted(l, key=lambda session: self._start_position[session.id])
+
+    def next_sessions(self, time, count):
+        """
+        The first `count` sessions starting at or after `time`.
+        """
+        start = bisect.bisect_left(self._start_times, time.timestamp())
+        return self._sessions_by_start[start:start + count]
+
+    def running_sessions(self, time):
+        """
+        Sessions that have started before or at `time` and did not end yet.
+        """
+        timestamp = time.timestamp()
+        start = bisect.bisect_left(self._start_times, timestamp - self._max_duration)
+        end = bisect.bisect_right(self._start_times, timestamp)
+        return [session for session in self._sessions_by_start[start:end]
+                if session.date.timestamp() + session.duration.total_seconds() > timestamp]
+
+    def upcoming_sessions(self, session_ids, time):
+        """
+        The sessions out of `session_ids` that did not end before `time`, ordered by their start.
+        """
+        timestamp = time.timestamp()
+        first = bisect.bisect_left(self._start_times, timestamp - self._max_duration)
+        positions = sorted(position for position in (self._start_position.get(session_id) for session_id in session_ids)
+                           if position is not None and position >= first)
+
+        sessions = (self._sessions_by_start[position] for position in positions)
+        return [session for session in sessions
+                if session.date.timestamp() + session.duration.total_seconds() >= timestamp]
+
+    def sessions_between(self, start_time, end_time):
+        """
+        Sessions starting in [start_time, end_time).
+        """
+        start = bisect.bisect_left(self._start_times, start_time.timestamp())
+        end = bisect.bisect_left(self._start_times, end_time.timestamp())
+        return self._sessions_by_start[start:end]
 
     def isessions(self):
         for day in self.conference.days:
@@ -1008,52 +2389,109 @@ class Schedule:
                 for session_id, session in room.sessions.items():
                     yield session
 
-    def search_sessions(self, search_string, max_results=10):
-        search_string = search_string.lower()
-        sessions = []
-        do_not_record = False
+    @property
+    def search_index(self):
+        """
+        Built on first use, the refresh worker does that before publishing the schedule.
+        """
+        with self._search_index_lock:
+            if self._search_index is None:
+                self._search_index = SearchIndex(self._sessions_by_start)
+            return self._search_index
+
+    def search_sessions(self, search_string, max_results=10, mask=None):
+        """
+        :param mask: restricts the search to these sessions, see facet_mask
+        """
+        index = self.search_index
+        if not index.has_terms(search_string):
+            # only filters, their sessions in order
+            if mask is None:
+                return []
+            return [self._sessions_by_start[position] for position in itertools.islice(iter_bits(mask), max_results)]
+
+        allowed = set(self._sessions_by_start[position].id for position in iter_bits(mask)) if mask is not None else None
+        session_ids = index.search(search_string, self._start_position.__getitem__, allowed=allowed, limit=max_results)
+        return [self._session_by_id[session_id] for session_id in session_ids]
 
-        def to_str(s):
-            if s:
-                return str(s)
-            return ""
+    @classmethod
+    def from_json(cls, schedule_json, hashsum=None):
+        conference = Conference.from_json(schedule_json['conference'])
+        return cls(schedule_json.get('version', 'none'), conference, hashsum=hashsum)
 
-        if 'do_not_record' in search_string:
-            do_not_record = True
-            search_string = search_string.replace('do_not_record', '')
+    def patch(self, schedule_json, hashsum=None):
+        """
+        Builds the schedule for `schedule_json`, sharing every session, room
+        and day that did not change with this one.
+        """
+        patch = SchedulePatch(self)
+        conference = Conference.from_json(schedule_json['conference'], patch=patch, previous=self.conference)
+        logger.info('Patched schedule: %d sessions reused, %d rebuilt', patch.reused, len(patch.rebuilt))
 
-        for session in self.isessions():
-            if search_string in to_str(session.title).lower() or \
-                            search_string in to_str(session.description).lower() or \
-                            search_string in to_str(session.abstract).lower() or \
-                    any(search_string in to_str(p.public_name).lower() for p in session.persons) or \
-                    do_not_record and session.do_not_record:
-                sessions.append(session)
+        return Schedule(schedule_json.get('version', 'none'), conference, hashsum=hashsum, patch=patch)
 
-                if len(sessions) >= max_results:
-                    break
 
-        return sessions
+class ScheduleDownload:
+    """
+    A downloaded and parsed schedule along with what the download task has to
+    remember about it once the schedule was published, see ScheduleDownloadTask.accept.
+    """
 
-    @classmethod
-    def from_json(cls, schedule_json):
-        conference = Conference.from_json(schedule_json['conference'])
-        return cls(schedule_json.get('version', 'none'), conference)
+    def __init__(self, hashsum, schedule, content, etag=None, last_modified=None):
+        self.hashsum = hashsum
+        self.schedule = schedule
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
 
 
 class ScheduleDownloadTask:
-    def __init__(self, url):
-        self.url = url
+    TIMEOUT = 60
 
-    def run(self):
+    def __init__(self, url, session=None, hashsum=None, snapshot_path=None):
+        self.url = url
+        self.snapshot_path = snapshot_path
+        self.session = requests.Session() if session is None else session
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+        # hashsum and validators of the last accepted response
+        self.hashsum = hashsum
+        self.etag = None
+        self.last_modified = None
+
+    def _conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def run(self, previous=None):
+        """
+        Downloads the schedule. If `previous` is given the new schedule is
+        patched into it instead of being built from scratch.
+
+        :return: a ScheduleDownload, NOT_MODIFIED or None if the download failed.
+            The task only remembers a ScheduleDownload once it is passed to `accept`.
+        """
         try:
-            response = requests.get(self.url)
-        except requests.ConnectionError as e:
+            response = self.session.get(self.url, headers=self._conditional_headers(), timeout=self.TIMEOUT)
+        except requests.RequestException as e:
             logger.exception(e)
             return None
         else:
+            if response.status_code == 304:
+                logger.info('Schedule not modified since the last download')
+                return NOT_MODIFIED
+
+            hashsum = hashlib.md5(response.content).hexdigest()
+            if response.status_code == 200 and hashsum == self.hashsum:
+                logger.info('Schedule content unchanged (%s)', hashsum)
+                self._update_validators(response)
+                return NOT_MODIFIED
+
             try:
-                hashsum = hashlib.md5(response.content).hexdigest()
                 response_json = response.json()
                 schedule_json = response_json['schedule']
             except Exception as e:
@@ -1061,90 +2499,685 @@ class ScheduleDownloadTask:
                 return None
             else:
                 try:
-                    return hashsum, Schedule.from_json(schedule_json)
+                    if previous is None:
+                        schedule = Schedule.from_json(schedule_json, hashsum=hashsum)
+                    else:
+                        schedule = previous.patch(schedule_json, hashsum=hashsum)
                 except (KeyError, IndexError) as e:
                     logger.exception(e)
                     return None
 
+                return ScheduleDownload(hashsum, schedule, response.content,
+                                        etag=response.headers.get('ETag'),
+                                        last_modified=response.headers.get('Last-Modified'))
+
+    def accept(self, download):
+        """
+        Remembers `download` as the current schedule once it is published, so
+        the same content is not parsed again and the snapshot holds it.
+        """
+        self.hashsum = download.hashsum
+        self.etag = download.etag
+        self.last_modified = download.last_modified
+        self._save_snapshot(download.content)
+
+    def _save_snapshot(self, content):
+        if not self.snapshot_path:
+            return
+
+        try:
+            save_schedule_snapshot(self.snapshot_path, content, self.hashsum, self.etag, self.last_modified,
+                                   url=self.url)
+        except OSError as e:
+            logger.warning('Failed to write schedule snapshot %s: %s', self.snapshot_path, e)
+
+    def _update_validators(self, response):
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+
+
+class Hall:
+    __slots__ = ('name', 'channel', 'stream', 'aliases')
+
+    def __init__(self, name, channel=None, stream=None, aliases=()):
+        self.name = name
+        self.channel = channel
+        self.stream = stream
+        self.aliases = tuple(aliases)
+
+
+class RoomRegistry:
+    """
+    Maps the rooms of the schedule (by name or alias, case-insensitively) to
+    their hall channel and stream slug.
+    """
+    def __init__(self, halls, source=None):
+        self.source = source
+        self.halls = list(halls)
+
+        self._by_room = {}
+        self._by_name = {}
+        for hall in self.halls:
+            for name in (hall.name,) + hall.aliases:
+                self._by_room[name.lower()] = hall
+
+            if hall.channel:
+                for name in (hall.name, hall.channel, hall.channel.lstrip('#')) + hall.aliases:
+                    self._by_name.setdefault(name.lower(), hall.channel)
 
-class ScheduledSession:
-    def __init__(self, scheduled_start_timer, start_timer):
-        self.scheduled_start_timer = scheduled_start_timer
-        self.start_timer = start_timer
+        self.channels = frozenset(Identifier(hall.channel) for hall in self.halls if hall.channel)
+
+    @classmethod
+    def parse(cls, value):
+        """
+        :param value: one room per line: name | hall channel | stream slug | aliases, comma separated
+        """
+        halls = []
+        for line in value.splitlines():
+            if not line.strip():
+                continue
+
+            fields = [field.strip() for field in line.split('|')] + [''] * 3
+            name, channel, stream, aliases = fields[:4]
+            halls.append(Hall(name, channel or None, stream or None,
+                              [alias.strip() for alias in aliases.split(',') if alias.strip()]))
+
+        return cls(halls, source=value)
+
+    def get(self, room):
+        return self._by_room.get(room.lower())
+
+    def channel_for_room(self, room):
+        hall = self.get(room)
+        return hall.channel if hall else None
+
+    def stream_for_room(self, room):
+        hall = self.get(room)
+        return hall.stream if hall and hall.stream else room
+
+    def channel_from_str(self, arg):
+        """
+        The hall channel named by a room name, an alias or the channel with or without #.
+        """
+        return self._by_name.get(arg.lower())
+
+
+class ResponseCache:
+    """
+    LRU cache of rendered command responses.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class AccountIndex:
+    """
+    Maps services accounts to the nicks that are logged in to them.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts = {}
+        self._nicks = {}
+
+    @classmethod
+    def from_users(cls, users):
+        index = cls()
+        for user in list(users.values()):
+            if user.account:
+                index.set(user.nick, user.account)
+        return index
+
+    def set(self, nick, account):
+        with self._lock:
+            self._discard(nick)
+            if account:
+                self._accounts[nick] = account
+                self._nicks.setdefault(account, set()).add(nick)
+
+    def discard(self, nick):
+        with self._lock:
+            self._discard(nick)
+
+    def _discard(self, nick):
+        account = self._accounts.pop(nick, None)
+        if account is not None:
+            nicks = self._nicks[account]
+            nicks.discard(nick)
+            if not nicks:
+                del self._nicks[account]
+
+    def rename(self, old, new):
+        with self._lock:
+            account = self._accounts.get(old)
+            self._discard(old)
+            if account is not None:
+                self._discard(new)
+                self._accounts[new] = account
+                self._nicks.setdefault(account, set()).add(new)
+
+    def nicks(self, account):
+        with self._lock:
+            return list(self._nicks.get(account, ()))
+
+
+class TopicReconciler:
+    """
+    Keeps the topic we want for each channel (desired) and the one the server
+    told us about (actual), and sends a TOPIC whenever they differ.
+
+    The server may shorten a topic we set. The topic it reports back from
+    our own change is accepted as the settled form of the desired one, so a
+    topic that is too long is not sent over and over. A change by someone
+    else gets the desired topic back.
+
+    Nothing is sent for a channel before its actual topic is known, i.e. before
+    we joined it. A channel gets at most one topic change per `debounce`
+    seconds from us; whatever is desired at the end of that wait is sent.
+    """
+    def __init__(self, send, debounce, clock=time.monotonic):
+        self.send = send
+        self.debounce = debounce
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._desired = {}
+        self._actual = {}
+        # the desired topic we sent last and the form the server settled it on
+        self._sent = {}
+        self._settled = {}
+        self._last_sent = {}
+        self._timers = {}
+        self._stopped = False
 
     def stop(self):
-        if self.start_timer and not self.start_timer.finished.is_set():
-            logger.debug('stopping start_timer')
-            self.start_timer.cancel()
+        with self._lock:
+            self._stopped = True
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers.clear()
+
+    def topic(self, channel):
+        channel = Identifier(channel)
+        with self._lock:
+            return self._actual.get(channel)
+
+    def set(self, channel, topic):
+        channel = Identifier(channel)
+        with self._lock:
+            if self._desired.get(channel) != topic:
+                self._desired[channel] = topic
+                self._settled.pop(channel, None)
+        self.reconcile(channel)
+
+    def observed(self, channel, topic, ours=False):
+        """
+        :param ours: the topic was set by us
+        """
+        channel = Identifier(channel)
+        with self._lock:
+            self._actual[channel] = topic
+            if ours and self._sent.get(channel) == self._desired.get(channel):
+                self._settled[channel] = topic
+        self.reconcile(channel)
+
+    def reconcile(self, channel):
+        with self._lock:
+            self._timers.pop(channel, None)
+            if self._stopped:
+                return
+
+            desired = self._desired.get(channel)
+            actual = self._actual.get(channel)
+            if desired is None or actual is None or actual in (desired, self._settled.get(channel)):
+                return
+
+            now = self.clock()
+            last_sent = self._last_sent.get(channel)
+            if last_sent is not None and now - last_sent < self.debounce:
+                if channel not in self._timers:
+                    timer = self._timers[channel] = threading.Timer(last_sent + self.debounce - now,
+                                                                    self.reconcile, args=(channel,))
+                    timer.daemon = True
+                    timer.start()
+                return
+
+            self._sent[channel] = desired
+            self._last_sent[channel] = now
 
-        if self.scheduled_start_timer and not self.scheduled_start_timer.finished.is_set():
-            logger.debug('stopping scheduled_start_timer')
-            self.scheduled_start_timer.cancel()
+        logger.info('Changing the topic of %s', channel)
+        self.send(channel, desired)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """
+        Seconds until a token is available
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+# start announcements and topics, subscriber notifications, command replies
+PRIORITY_ANNOUNCEMENT, PRIORITY_NOTIFICATION, PRIORITY_REPLY = range(3)
+PRIORITY_NAMES = ('announcements', 'notifications', 'replies')
+
+
+class OutgoingQueue:
+    """
+    Sends our messages from a single thread, limited by a global token bucket
+    and one token bucket per target.
+
+    The highest priority message whose target bucket allows it goes first.
+    Within a priority the targets take turns, so a long reply to one user
+    does not hold back the others.
+    """
+    # targets idle for this long have a full bucket again and are forgotten
+    BUCKET_EXPIRY = 300
+
+    def __init__(self, bot, rate, burst, target_rate, target_burst, clock=time.monotonic):
+        self.bot = bot
+        self.clock = clock
+
+        self.target_rate = target_rate
+        self.target_burst = target_burst
+        self._bucket = TokenBucket(rate, burst, clock())
+        self._target_buckets = {}
+
+        # per priority: target -> deque of (enqueued at, command, text, max_messages)
+        self._queues = [collections.OrderedDict() for _ in PRIORITY_NAMES]
+        self._stats = [dict(queued=0, sent=0, total_wait=0.0, max_wait=0.0) for _ in PRIORITY_NAMES]
+
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
 
     def start(self):
-        if self.start_timer:
-            self.start_timer.start()
-        if self.scheduled_start_timer:
-            self.scheduled_start_timer.start()
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+
+        self._thread = threading.Thread(target=self._run, name='c3schedule-outgoing')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def put(self, priority, command, target, text, max_messages=1):
+        with self._condition:
+            queue = self._queues[priority].setdefault(target, collections.deque())
+            queue.append((self.clock(), command, text, max_messages))
+            self._stats[priority]['queued'] += 1
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return dict((priority, dict(
+                queued=stats['queued'],
+                sent=stats['sent'],
+                average_wait=stats['total_wait'] / stats['sent'] if stats['sent'] else 0.0,
+                max_wait=stats['max_wait'],
+            )) for priority, stats in enumerate(self._stats))
+
+    def _target_bucket(self, target, now):
+        bucket = self._target_buckets.get(target)
+        if bucket is None:
+            bucket = self._target_buckets[target] = TokenBucket(self.target_rate, self.target_burst, now)
+        return bucket
+
+    def _pop_sendable(self, now):
+        """
+        Takes the next message that may be sent now
+        :return: (message, None) or (None, seconds until one may be sent or None if nothing is queued)
+        """
+        wait = self._bucket.wait_time(now)
+        if wait > 0:
+            return None, wait if any(self._queues) else None
+
+        wait = None
+        for priority, queues in enumerate(self._queues):
+            for target, queue in queues.items():
+                bucket = self._target_bucket(target, now)
+                target_wait = bucket.wait_time(now)
+                if target_wait > 0:
+                    wait = target_wait if wait is None else min(wait, target_wait)
+                    continue
+
+                enqueued, command, text, max_messages = queue.popleft()
+                if queue:
+                    # the other targets of this priority go first next time
+                    queues.move_to_end(target)
+                else:
+                    del queues[target]
+
+                bucket.take(now)
+                self._bucket.take(now)
+
+                stats = self._stats[priority]
+                stats['queued'] -= 1
+                stats['sent'] += 1
+                stats['total_wait'] += now - enqueued
+                stats['max_wait'] = max(stats['max_wait'], now - enqueued)
+
+                return (command, target, text, max_messages), None
+
+        return None, wait
+
+    def _expire_buckets(self, now):
+        for target, bucket in list(self._target_buckets.items()):
+            if now - bucket.updated > self.BUCKET_EXPIRY:
+                del self._target_buckets[target]
+
+    def send_pending(self):
+        """
+        Sends everything the buckets allow right now
+        :return: the number of messages sent and the seconds until the next one may be sent (None if nothing is queued)
+        """
+        sent = 0
+        while True:
+            with self._condition:
+                message, wait = self._pop_sendable(self.clock())
+
+            if message is None:
+                return sent, wait
+
+            self._send(*message)
+            sent += 1
+
+    def _send(self, command, target, text, max_messages):
+        try:
+            if command == 'TOPIC':
+                self.bot.write(('TOPIC', target + ' :' + text))
+            else:
+                self.bot.msg(target, text, max_messages)
+        except Exception as e:
+            logger.exception(e)
 
-    def finished(self):
-        return False  # FIXME: lets just stop the timers again..
-        return self.start_timer.finished.is_set() and self.scheduled_start_timer.finished.is_set()
+    def _run(self):
+        while True:
+            _, wait = self.send_pending()
+
+            with self._condition:
+                if not self._running:
+                    return
+
+                self._expire_buckets(self.clock())
+                if not any(self._queues):
+                    self._condition.wait()
+                else:
+                    self._condition.wait(wait)
 
 
 class AnnoucementScheduler:
+    """
+    Fires the announcements for sessions from a single dispatcher thread.
+
+    Pending announcements are kept in a heap ordered by their fire time.
+    Cancelled entries are only marked and dropped once they reach the top.
+    """
     NOTIFICATION_DELTA = datetime.timedelta(minutes=15)
+    # sessions starting within this window are armed
+    HORIZON = datetime.timedelta(hours=1)
+    # upper bound for sleeping, picks up changes of the (fake) clock
+    MAX_WAIT = 60
+
+    SCHEDULED_START = 'scheduled_start'
+    START = 'start'
 
-    def __init__(self, bot, timers=None):
+    def __init__(self, bot, clock=None, coalesce_window=0):
         self.bot = bot
-        self.timers = {} if timers is None else timers
+        # returns the current time as unix timestamp
+        self.clock = clock if clock is not None else lambda: get_now(bot).timestamp()
+        # events due within this many seconds of each other are fired together
+        self.coalesce_window = coalesce_window
+
+        # entries are [fire_time, sequence, kind, session_id, active]
+        self._heap = []
+        self._sequence = itertools.count()
+        # session_id -> {kind: entry}
+        self._events = {}
+        self.pending = 0
+        # sessions starting before this timestamp have been armed
+        self.horizon = None
+
+        self._condition = threading.Condition(threading.RLock())
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+
+        self._thread = threading.Thread(target=self._run, name='c3schedule-announcer')
+        self._thread.daemon = True
+        self._thread.start()
 
     def stop(self):
         logger.info('Stopping scheduled announcements')
-        for timer in self.timers.values():
-            if not timer.finished():
-                timer.stop()
+        with self._condition:
+            self._running = False
+            self._clear()
+            self._condition.notify()
+
+    def clear(self):
+        with self._condition:
+            self._clear()
+
+    def _clear(self):
+        for entry in self._heap:
+            entry[-1] = False
+        self._heap = []
+        self._events = {}
+        self.pending = 0
+        self.horizon = None
+
+    def top_up(self, schedule):
+        """
+        Arms the sessions of `schedule` that entered the horizon since the
+        last call. Only that new slice of time is looked at.
+        """
+        with self._condition:
+            now = self.clock()
+            end = now + self.HORIZON.total_seconds()
+
+            start = self.horizon
+            if start is None or start < now or start > end:
+                # first call, or the (fake) clock jumped
+                start = now
+
+            for session in schedule.sessions_between(pendulum.from_timestamp(start), pendulum.from_timestamp(end)):
+                self.add(session)
+
+            self.horizon = end
+
+    def announce_starts(self, sessions):
+        announce_starts(self.bot, sessions)
+
+    def announce_scheduled_starts(self, sessions):
+        announce_scheduled_starts(self.bot, sessions)
 
-        self.timers = {}
+    def add(self, session):
+        with self._condition:
+            if session.id in self._events:
+                return
 
-    def announce_start(self, session):
-        announce_start(self.bot, session)
+            now = self.clock()
+            start = session.date.timestamp()
 
-    def announce_scheduled_start(self, session):
-        announce_scheduled_start(self.bot, session)
+            if start < now:
+                return
 
-    def add(self, session):
+            events = {}
+            notification_time = start - self.NOTIFICATION_DELTA.total_seconds()
+            if notification_time > now:
+                events[self.SCHEDULED_START] = self._push(notification_time, self.SCHEDULED_START, session.id)
+            events[self.START] = self._push(start, self.START, session.id)
 
-        if session.id in self.timers:
-            return
+            self._events[session.id] = events
+            self._condition.notify()
 
-        now = get_now(self.bot)
+        logger.info('Scheduled announcers for session.id %s. Start announcement in %ds.', session.id, start - now)
 
-        if session.date < now:
-            return
+    def cancel(self, session_id):
+        with self._condition:
+            for entry in self._events.pop(session_id, {}).values():
+                entry[-1] = False
+                self.pending -= 1
 
-        # calculate time till NOTIFICATION_DELTA is reached
-        notification_time = session.date - self.NOTIFICATION_DELTA
-        if notification_time < now:
-            notification_time = now
+    def apply_changes(self, changed_sessions, added_sessions, missing_sessions):
+        """
+        Updates the armed announcements with the result of `diff_schedules`.
 
-        delay = (notification_time - now).total_seconds()
-        if delay < 0:
-            delay = 0
+        Only sessions that moved in time are re-armed. Everything else is
+        resolved from the published schedule when it fires, so a new room or
+        title needs no action here.
+        """
+        with self._condition:
+            for session in missing_sessions:
+                self.cancel(session.id)
 
-        announce_delay = (session.date - now).total_seconds()
+            for change in changed_sessions:
+                if change.moved_start:
+                    self.cancel(change.session.id)
+                    self._add_within_horizon(change.session)
 
-        if delay > 0:
-            scheduled_timer = threading.Timer(delay, self.announce_scheduled_start, (session,))
-        else:
-            scheduled_timer = None
+            for session in added_sessions:
+                self._add_within_horizon(session)
+
+    def _add_within_horizon(self, session):
+        if self.horizon is not None and session.date.timestamp() < self.horizon:
+            self.add(session)
+
+    def _push(self, fire_time, kind, session_id):
+        entry = [fire_time, next(self._sequence), kind, session_id, True]
+        heapq.heappush(self._heap, entry)
+        self.pending += 1
+        return entry
+
+    def _drop_cancelled(self):
+        while self._heap and not self._heap[0][-1]:
+            heapq.heappop(self._heap)
+
+    def _pop_due(self, now):
+        due = []
+
+        self._drop_cancelled()
+        # the first due event waits for the others of its window, nothing is fired early
+        if not self._heap or self._heap[0][0] + self.coalesce_window > now:
+            return due
+
+        while self._heap and self._heap[0][0] <= now:
+            fire_time, _, kind, session_id, active = heapq.heappop(self._heap)
+            if not active:
+                continue
+
+            events = self._events[session_id]
+            del events[kind]
+            if not events:
+                del self._events[session_id]
+            self.pending -= 1
+            due.append((kind, session_id))
+
+        return due
+
+    def _next_timeout(self):
+        self._drop_cancelled()
+
+        if not self._heap:
+            return self.MAX_WAIT
+
+        return min(self._heap[0][0] + self.coalesce_window - self.clock(), self.MAX_WAIT)
+
+    def run_pending(self):
+        """
+        Fires all announcements that are due.
+        :return: the number of announcements fired
+        """
+        with self._condition:
+            due = self._pop_due(self.clock())
+
+        if due:
+            self._fire(due)
+
+        return len(due)
+
+    def _fire(self, due):
+        schedule = self.bot.memory['c3schedule']
+        sessions = {self.SCHEDULED_START: [], self.START: []}
+
+        for kind, session_id in due:
+            session = schedule.get_session(session_id) if schedule else None
+            if session is None:
+                logger.info('Session %s vanished before its announcement', session_id)
+            else:
+                sessions[kind].append(session)
+
+        try:
+            if sessions[self.SCHEDULED_START]:
+                self.announce_scheduled_starts(sessions[self.SCHEDULED_START])
+            if sessions[self.START]:
+                self.announce_starts(sessions[self.START])
+        except Exception as e:
+            logger.exception(e)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
 
-        start_timer = threading.Timer(announce_delay, self.announce_start, (session,))
+                timeout = self._next_timeout()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
 
-        ss = ScheduledSession(scheduled_start_timer=scheduled_timer, start_timer=start_timer)
-        self.timers[session.id] = ss
-        ss.start()
-        logger.info(
-            'Scheduled announcers for session.id {}. Start annoucement in {}. Announce delay: {}'.format(session.id,
-                                                                                                         delay,
-                                                                                                         announce_delay))
+            self.run_pending()
@@ -0,0 +1,63 @@
+"""
+Times Schedule.from_json on ../old1.json with the memoized frab date parsing
+against the previous dateutil based parsing.
+
+Run from the modules directory: python c3schedule_irc_bench.py
+"""
+import json
+import timeit
+import datetime
+from unittest import mock
+
+import dateutil.parser
+import pendulum
+
+import c3schedule_irc
+from c3schedule_irc import Schedule
+
+ROUNDS = 10
+
+
+def dateutil_parse_day(s):
+    return pendulum.Pendulum.instance(dateutil.parser.parse(s))
+
+
+def uncached_parse_duration(s):
+    parts = s.split(':')
+    days = 0
+    if len(parts) == 2:
+        hours, minutes = parts
+    elif len(parts) == 3:
+        days, hours, minutes = parts
+
+    return pendulum.Interval.instance(datetime.timedelta(days=int(days), hours=int(hours), minutes=int(minutes)))
+
+
+def clear_caches():
+    c3schedule_irc.parse_day.cache_clear()
+    c3schedule_irc.parse_duration.cache_clear()
+
+
+def main():
+    with open('../old1.json', 'r') as fh:
+        schedule_json = json.loads(fh.read())['schedule']
+
+    with mock.patch('c3schedule_irc.parse_day', dateutil_parse_day), \
+            mock.patch('c3schedule_irc.parse_duration', uncached_parse_duration):
+        baseline = min(timeit.repeat(lambda: Schedule.from_json(schedule_json), number=1, repeat=ROUNDS))
+
+    def cold():
+        clear_caches()
+        Schedule.from_json(schedule_json)
+
+    cold_time = min(timeit.repeat(cold, number=1, repeat=ROUNDS))
+    warm_time = min(timeit.repeat(lambda: Schedule.from_json(schedule_json), number=1, repeat=ROUNDS))
+
+    print('Schedule.from_json(old1.json), best of {}'.format(ROUNDS))
+    print('  dateutil:        {:8.2f} ms'.format(baseline * 1000))
+    print('  fast, cold memo: {:8.2f} ms ({:.1f}x)'.format(cold_time * 1000, baseline / cold_time))
+    print('  fast, warm memo: {:8.2f} ms ({:.1f}x)'.format(warm_time * 1000, baseline / warm_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,27 @@
+import os
+import re
+import sys
 import json
+import zlib
+import hashlib
+import datetime
+import sqlite3
+import tempfile
 from copy import deepcopy
-from unittest import TestCase
+import dateutil.parser
+import jinja2
+import pendulum
+import sopel.formatting
+from types import SimpleNamespace
+from unittest import TestCase, mock
 
-from c3schedule_irc import Schedule, diff_schedules, ScheduleDownloadTask
+from c3schedule_irc import Schedule, diff_schedules, ScheduleDownloadTask, NOT_MODIFIED, refresh_schedule, \
+    load_schedule_snapshot, save_schedule_snapshot, parse_day, AnnoucementScheduler, pack_lines, send_digest, \
+    OutgoingQueue, PRIORITY_ANNOUNCEMENT, PRIORITY_NOTIFICATION, PRIORITY_REPLY, AccountIndex, \
+    SubscriptionStore, setup_database, select_sessions, \
+    parse_targmax, send_to_many, parse_search_query, \
+    ResponseCache, show_nextup, render_jinja, compile_template, reset_templates, RoomRegistry, DEFAULT_ROOMS, \
+    TopicReconciler, iter_bits, require_schedule, reply, start_topics, stop_topics
 
 
 class TestScheduleDiff(TestCase):
@@ -60,6 +79,16 @@ class TestScheduleDiff(TestCase):
 
         self.assertEqual(self.schedule.conference.days[0].rooms['Saal 1'].sessions[123], schedule.conference.days[0].rooms['Saal 1'].sessions[123])
 
+    def test_schedule_shares_persons(self):
+        new_schedule_json = deepcopy(self.schedule_json)
+        new_schedule_json['conference']['days'][0]['rooms']['Saal 1'][0]['persons'] = [
+            dict(id=1, public_name='Jane Doe')]
+        schedule = Schedule.from_json(new_schedule_json)
+        schedule2 = Schedule.from_json(deepcopy(new_schedule_json))
+
+        self.assertIs(schedule.get_session(123).persons[0], schedule2.get_session(123).persons[0])
+        self.assertIs(schedule.get_session(123).room, schedule2.get_session(123).room)
+
     def test_schedule_addition(self):
         new_schedule_json = deepcopy(self.schedule_json)
         new_schedule_json['version'] = 'ff'
@@ -120,6 +149,34 @@ class TestScheduleDiff(TestCase):
         self.assertEqual(len(changed), 1)
         self.assertEqual(len(added), 0)
         self.assertEqual(len(missing), 0)
+        self.assertEqual(changed[0].fields, ('date',))
+        self.assertTrue(changed[0].moved_start)
+        self.assertFalse(changed[0].moved_room)
+
+    def test_schedule_modified_fields(self):
+        new_schedule_json = deepcopy(self.schedule_json)
+        session_json = new_schedule_json['conference']['days'][0]['rooms']['Saal 1'][0]
+        session_json['title'] = 'rofl'
+        session_json['persons'] = [dict(id=1, public_name='Jane Doe')]
+        session_json['url'] = 'https://example.com/ignored'
+
+        new_schedule = Schedule.from_json(new_schedule_json)
+
+        changed, added, missing = diff_schedules(self.schedule, new_schedule)
+
+        self.assertEqual(len(changed), 1)
+        self.assertEqual(changed[0].fields, ('title', 'persons'))
+        self.assertEqual(changed[0].describe(), 'new title, speakers changed')
+
+    def test_schedule_unmodelled_change(self):
+        new_schedule_json = deepcopy(self.schedule_json)
+        new_schedule_json['conference']['days'][0]['rooms']['Saal 1'][0]['url'] = 'https://example.com/ignored'
+
+        new_schedule = Schedule.from_json(new_schedule_json)
+
+        changed, added, missing = diff_schedules(self.schedule, new_schedule)
+
+        self.assertEqual(len(changed), 0)
 
     def test_schedule_modified_moved_date(self):
         new_schedule_json = deepcopy(self.schedule_json)
@@ -167,16 +224,83 @@ class TestScheduleDiff(TestCase):
         self.assertEqual(len(missing), 0)
         self.assertEqual(len(changed), 1)
 
+    def test_schedule_patch(self):
+        new_schedule_json = deepcopy(self.schedule_json)
+        new_schedule_json['version'] = 'ff'
+        new_schedule_json['conference']['days'][0]['rooms']['Saal 2'] = [
+            dict(new_schedule_json['conference']['days'][0]['rooms']['Saal 1'][0], id=1243, room='Saal 2')]
+
+        new_schedule = self.schedule.patch(new_schedule_json)
+
+        self.assertEqual(new_schedule.version, 'ff')
+        self.assertIs(new_schedule.get_session(123), self.schedule.get_session(123))
+        self.assertIs(new_schedule.conference.days[0].rooms['Saal 1'], self.schedule.conference.days[0].rooms['Saal 1'])
+        self.assertEqual(new_schedule.get_session(1243).room, 'Saal 2')
+
+        changed, added, missing = diff_schedules(self.schedule, new_schedule)
+        self.assertEqual(len(changed), 0)
+        self.assertEqual([s.id for s in added], [1243])
+
+    def test_schedule_patch_equals_rebuild(self):
+        with open('../old1.json', 'r') as fh:
+            old1 = json.loads(fh.read())['schedule']
+
+        with open('../old2.json', 'r') as fh:
+            old2 = json.loads(fh.read())['schedule']
+
+        previous = Schedule.from_json(old1)
+        previous.search_index
+        patched = previous.patch(old2)
+        rebuilt = Schedule.from_json(old2)
+
+        self.assertEqual(patched._session_by_id.keys(), rebuilt._session_by_id.keys())
+        self.assertEqual([s.id for s in patched.isessions()], [s.id for s in rebuilt.isessions()])
+        results = diff_schedules(patched, rebuilt)
+        for result in results:
+            self.assertEqual(len(result), 0)
+        self.assertPatchedIndexes(patched, rebuilt)
+
+    def test_schedule_patch_indexes(self):
+        with open('../old1.json', 'r') as fh:
+            old1 = json.loads(fh.read())['schedule']
+
+        previous = Schedule.from_json(deepcopy(old1))
+        previous.search_index
+
+        day = old1['conference']['days'][1]
+        rooms = list(day['rooms'].values())
+        rooms[0][0]['title'] = 'Entirely new words'
+        rooms[0][1]['date'] = old1['conference']['days'][2]['rooms'][list(day['rooms'])[0]][0]['date']
+        rooms[1][0]['persons'] = []
+        removed = rooms[1].pop()
+        added = dict(rooms[1][0], id=999999, guid='added', title='Another talk', do_not_record=True)
+        rooms[2].append(added)
+
+        patched = previous.patch(deepcopy(old1))
+        self.assertEqual(patched.get_session(removed['id']), None)
+        self.assertIsNotNone(patched.get_session(999999))
+        self.assertPatchedIndexes(patched, Schedule.from_json(deepcopy(old1)))
+
+    def assertPatchedIndexes(self, patched, rebuilt):
+        self.assertEqual([s.id for s in patched._sessions_by_start], [s.id for s in rebuilt._sessions_by_start])
+        self.assertEqual(patched._start_times, rebuilt._start_times)
+        self.assertEqual(patched._start_position, rebuilt._start_position)
+        self.assertEqual(patched._max_duration, rebuilt._max_duration)
+        self.assertEqual(patched._facets, rebuilt._facets)
+
+        self.assertIsNotNone(patched._search_index)
+        self.assertEqual(patched.search_index._postings, rebuilt.search_index._postings)
+        self.assertEqual(patched.search_index._tokens, rebuilt.search_index._tokens)
+        self.assertEqual(patched.search_index._do_not_record, rebuilt.search_index._do_not_record)
+
     def test_donload(self):
         url = 'https://raw.githubusercontent.com/voc/33C3_schedule/master/everything.schedule.json'
 
-        task = ScheduleDownloadTask(url)
-        hashsum, schedule = task.run()
-        task = ScheduleDownloadTask(url)
-        hashsum2, schedule2 = task.run()
+        download = ScheduleDownloadTask(url).run()
+        download2 = ScheduleDownloadTask(url).run()
 
-        self.assertEqual(hashsum, hashsum2)
-        results = diff_schedules(schedule, schedule2)
+        self.assertEqual(download.hashsum, download2.hashsum)
+        results = diff_schedules(download.schedule, download2.schedule)
         for result in results:
             self.assertEqual(len(result), 0)
 
@@ -194,3 +318,786 @@ class TestScheduleDiff(TestCase):
 
         results = diff_schedules(o1, o2)
 
+
+class FakeResponse:
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class FakeHTTPSession:
+    def __init__(self, responses):
+        self.headers = {}
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+
+class TestScheduleDownloadTask(TestCase):
+    def setUp(self):
+        with open('../old1.json', 'rb') as fh:
+            self.content = fh.read()
+
+    def test_conditional_request(self):
+        session = FakeHTTPSession([
+            FakeResponse(200, self.content, {'ETag': '"abc"', 'Last-Modified': 'Tue, 27 Dec 2016 10:00:00 GMT'}),
+            FakeResponse(304),
+        ])
+        task = ScheduleDownloadTask('http://example.com/schedule.json', session=session)
+
+        download = task.run()
+        self.assertIsNotNone(download.schedule)
+        self.assertEqual(session.requests[0], {})
+        self.assertIn('gzip', session.headers['Accept-Encoding'])
+        task.accept(download)
+
+        self.assertIs(task.run(), NOT_MODIFIED)
+        self.assertEqual(session.requests[1], {
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': 'Tue, 27 Dec 2016 10:00:00 GMT',
+        })
+
+    def test_unchanged_content_is_not_parsed(self):
+        session = FakeHTTPSession([
+            FakeResponse(200, self.content),
+            FakeResponse(200, self.content, {'ETag': '"def"'}),
+        ])
+        task = ScheduleDownloadTask('http://example.com/schedule.json', session=session)
+        download = task.run()
+        task.accept(download)
+
+        with mock.patch.object(Schedule, 'from_json') as from_json:
+            self.assertIs(task.run(), NOT_MODIFIED)
+            from_json.assert_not_called()
+
+        self.assertEqual(task.hashsum, download.hashsum)
+        self.assertEqual(task.etag, '"def"')
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'c3schedule.snapshot')
+            session = FakeHTTPSession([FakeResponse(200, self.content, {'ETag': '"abc"'})])
+            task = ScheduleDownloadTask('http://example.com/schedule.json', session=session, snapshot_path=path)
+            download = task.run()
+            self.assertFalse(os.path.exists(path))
+            self.assertIsNone(task.hashsum)
+
+            task.accept(download)
+            schedule = download.schedule
+            snapshot_schedule, etag, last_modified = load_schedule_snapshot(path)
+            self.assertEqual(snapshot_schedule.hashsum, download.hashsum)
+            self.assertEqual(etag, '"abc"')
+            self.assertIsNone(last_modified)
+            results = diff_schedules(schedule, snapshot_schedule)
+            for result in results:
+                self.assertEqual(len(result), 0)
+
+            with open(path, 'r+b') as fh:
+                fh.seek(-16, os.SEEK_END)
+                fh.write(b'\0' * 16)
+            self.assertIsNone(load_schedule_snapshot(path))
+
+            self.assertIsNone(load_schedule_snapshot(os.path.join(directory, 'missing.snapshot')))
+
+    def test_snapshot_of_other_url(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'c3schedule.snapshot')
+            save_schedule_snapshot(path, self.content, hashlib.md5(self.content).hexdigest(), '"abc"',
+                                   url='http://example.com/old.json')
+
+            self.assertIsNotNone(load_schedule_snapshot(path, url='http://example.com/old.json'))
+            self.assertIsNone(load_schedule_snapshot(path, url='http://example.com/new.json'))
+
+    def test_snapshot_of_unexpected_shape(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'c3schedule.snapshot')
+
+            with open(path, 'wb') as fh:
+                fh.write(b'c3schedule-snapshot\n[]\n' + zlib.compress(b'{}'))
+            self.assertIsNone(load_schedule_snapshot(path))
+
+            content = b'{"schedule": {"conference": []}}'
+            save_schedule_snapshot(path, content, hashlib.md5(content).hexdigest())
+            self.assertIsNone(load_schedule_snapshot(path))
+
+    def test_failed_download_keeps_validators(self):
+        session = FakeHTTPSession([
+            FakeResponse(200, self.content, {'ETag': '"abc"'}),
+            FakeResponse(500, b'Internal Server Error', {'ETag': '"broken"'}),
+        ])
+        task = ScheduleDownloadTask('http://example.com/schedule.json', session=session)
+        task.accept(task.run())
+
+        self.assertIsNone(task.run())
+        self.assertEqual(task.etag, '"abc"')
+
+
+class FakeBot:
+    def __init__(self):
+        self.memory = {'c3schedule': None, 'c3schedule_response_cache': ResponseCache(8)}
+        self.nick = 'c3schedule'
+        self.config = SimpleNamespace(c3schedule=SimpleNamespace(
+            channel='#schedule',
+            coalesce_window=5,
+            digest_start_prefix='NOW ',
+            digest_scheduled_start_prefix='In {{ countdown }}: ',
+            digest_separator=' | ',
+            session_url='https://fahrplan.events.ccc.de/congress/{{year}}/Fahrplan/events/{{id}}.html',
+        ))
+        self.messages = []
+
+    def msg(self, recipient, text, max_messages=1):
+        self.messages.append((recipient, text))
+
+    def write(self, args, text=None):
+        self.messages.append(args)
+
+
+class TestRefreshSchedule(TestCase):
+    def setUp(self):
+        with open('../old1.json', 'rb') as fh:
+            self.content = fh.read()
+
+        self.bot = FakeBot()
+        session = FakeHTTPSession([FakeResponse(200, self.content, {'ETag': '"abc"'}), FakeResponse(304)])
+        self.task = ScheduleDownloadTask('http://example.com/schedule.json', session=session)
+
+    def tearDown(self):
+        announcer = self.bot.memory.get('c3schedule_announcer')
+        if announcer:
+            announcer.stop()
+
+    def test_refresh_publishes_schedule(self):
+        with mock.patch('c3schedule_irc.get_download_task', return_value=self.task):
+            refresh_schedule(self.bot, startup=True)
+            schedule = self.bot.memory['c3schedule']
+            announcer = self.bot.memory['c3schedule_announcer']
+
+            self.assertIsNotNone(schedule)
+            self.assertIsNotNone(schedule.hashsum)
+
+            refresh_schedule(self.bot)
+
+        self.assertIs(self.bot.memory['c3schedule'], schedule)
+        self.assertIs(self.bot.memory['c3schedule_announcer'], announcer)
+        self.assertEqual(self.bot.messages, [])
+
+    def test_failed_publish_is_not_remembered(self):
+        with mock.patch('c3schedule_irc.get_download_task', return_value=self.task), \
+                mock.patch('c3schedule_irc.publish_schedule_update', side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, refresh_schedule, self.bot, startup=True)
+
+        self.assertIsNone(self.task.hashsum)
+        self.assertIsNone(self.task.etag)
+
+    def test_speaker_without_name(self):
+        content = json.loads(self.content.decode('utf-8'))
+        room = next(iter(content['schedule']['conference']['days'][1]['rooms'].values()))
+        room[0]['persons'][0]['public_name'] = None
+        self.task.session = FakeHTTPSession([FakeResponse(200, json.dumps(content).encode('utf-8'))])
+
+        with mock.patch('c3schedule_irc.get_download_task', return_value=self.task):
+            refresh_schedule(self.bot, startup=True)
+
+        self.assertIsNotNone(self.bot.memory['c3schedule'])
+        self.assertEqual(self.task.hashsum, self.bot.memory['c3schedule'].hashsum)
+
+
+class TestParsing(TestCase):
+    def test_parse_day_matches_dateutil(self):
+        for s in ['2016-12-27T11:00:00+01:00', '2016-12-27T23:30:00-03:30', '2016-12-27T11:00:00Z',
+                  '2016-12-27T11:00:00', '2016-12-27T11:00:00.5+01:00', '2016-12-27T11:00+0100', '27.12.2016 11:00']:
+            expected = pendulum.Pendulum.instance(dateutil.parser.parse(s))
+            self.assertEqual(parse_day(s), expected)
+            self.assertEqual(parse_day(s).utcoffset(), expected.utcoffset())
+
+
+class TestScheduleTimeIndex(TestCase):
+    def setUp(self):
+        with open('../old1.json', 'r') as fh:
+            self.schedule = Schedule.from_json(json.loads(fh.read())['schedule'])
+
+        self.now = parse_day('2016-12-28T14:10:00+01:00')
+
+    def test_next_sessions(self):
+        expected = sorted((s for s in self.schedule.isessions() if s.date >= self.now), key=lambda s: s.date)
+        next_sessions = self.schedule.next_sessions(self.now, 6)
+
+        self.assertEqual([s.date for s in next_sessions], [s.date for s in expected[:6]])
+        self.assertEqual(self.schedule.next_sessions(parse_day('2017-01-01T00:00:00+01:00'), 6), [])
+
+    def test_running_sessions(self):
+        expected = set(s.id for s in self.schedule.isessions() if s.date <= self.now < s.date + s.duration)
+
+        self.assertTrue(expected)
+        self.assertEqual(set(s.id for s in self.schedule.running_sessions(self.now)), expected)
+
+    def test_sessions_between(self):
+        end = self.now + datetime.timedelta(hours=1)
+        expected = set(s.id for s in self.schedule.isessions() if self.now <= s.date < end)
+
+        self.assertTrue(expected)
+        self.assertEqual(set(s.id for s in self.schedule.sessions_between(self.now, end)), expected)
+
+    def test_upcoming_sessions(self):
+        session_ids = [s.id for s in self.schedule.isessions()][::7]
+        expected = [s for s in self.schedule.get_sessions(session_ids) if s.date + s.duration >= self.now]
+
+        self.assertEqual(self.schedule.upcoming_sessions(session_ids, self.now), expected)
+
+    def test_facets(self):
+        security = set(s.id for s in self.schedule.isessions() if s.track == 'Security')
+        self.assertEqual(set(s.id for s in self.schedule.sessions_by_track('security')), security)
+
+        day = self.schedule.conference.days[1]
+        by_day = self.schedule.sessions_by_day('2016-12-28')
+        self.assertEqual(set(s.id for s in by_day),
+                         set(s.id for room in day.rooms.values() for s in room.sessions.values()))
+        self.assertEqual(by_day, sorted(by_day, key=lambda s: s.date))
+        # the topic calls 2016-12-28 Day 2
+        self.assertEqual(self.schedule.sessions_by_day('2'), by_day)
+
+    def test_search_sessions(self):
+        def words(session):
+            text = ' '.join([session.title or '', session.subtitle or '', session.abstract or '', session.description or ''] +
+                            [p.public_name or '' for p in session.persons])
+            return set(re.findall(r'\w+', text.lower()))
+
+        expected = set(s.id for s in self.schedule.isessions()
+                       if any(w.startswith('crypt') for w in words(s)) and any(w.startswith('part') for w in words(s)))
+        results = self.schedule.search_sessions('Crypt part', max_results=1000)
+
+        self.assertTrue(expected)
+        self.assertEqual(set(s.id for s in results), expected)
+        self.assertIn('crypt', self.schedule.search_sessions('crypt')[0].title.lower())
+
+        flagged = self.schedule.search_sessions('do_not_record', max_results=1000)
+        self.assertEqual(set(s.id for s in flagged), set(s.id for s in self.schedule.isessions() if s.do_not_record))
+        self.assertEqual(self.schedule.search_sessions('!!'), [])
+
+        # too short to expand, only whole words match
+        for session in self.schedule.search_sessions('in', max_results=1000):
+            self.assertIn('in', words(session))
+        self.assertEqual(len(self.schedule.search_sessions('the', max_results=3)), 3)
+
+    def test_search_filters(self):
+        bot = FakeBot()
+        day = self.schedule.conference.days[1]
+        session = next(s for s in self.schedule.sessions_by_day(day.date.isoformat()) if ' ' in s.room and s.track)
+
+        mask, text = parse_search_query(bot, self.schedule, 'room:"{}" day:2 track:{} foo'.format(
+            session.room.upper(), session.track.split()[0]))
+        self.assertEqual(text.strip(), 'foo')
+        self.assertEqual(mask, 0)
+
+        mask, text = parse_search_query(bot, self.schedule, 'room:"{}" day:{} after:{}'.format(
+            session.room, day.date.isoformat(), session.date.isoformat()))
+        expected = [s for s in self.schedule.isessions()
+                    if s.room == session.room and s.date.date() == day.date and s.date >= session.date]
+        self.assertEqual(self.schedule.search_sessions(text, max_results=100, mask=mask),
+                         sorted(expected, key=lambda s: s.date))
+
+        self.assertEqual(self.schedule.search_sessions(session.title, mask=mask)[0], session)
+
+        index = self.schedule.search_index
+        allowed = set(self.schedule._sessions_by_start[position].id for position in iter_bits(mask))
+        unmasked = index._prefix_matches('the')
+        self.assertEqual(index._prefix_matches('the', allowed),
+                         dict((ordinal, weight) for ordinal, weight in unmasked.items() if ordinal in allowed))
+        self.assertRaises(ValueError, parse_search_query, bot, self.schedule, 'after:soon')
+
+    def test_render_cache(self):
+        bot = FakeBot()
+        session = next(s for s in self.schedule.isessions() if s.track != 'self organized sessions')
+        session.prerender(bot)
+
+        summary = session.format_summary(color=sopel.formatting.colors.RED)
+        self.assertTrue(summary.startswith('[{}] '.format(session.room)))
+        self.assertIn(sopel.formatting.color(str(session.date), fg=sopel.formatting.colors.RED), summary)
+        self.assertTrue(summary.endswith(' ({})'.format(session.id)))
+        self.assertIn(' {:02}:{:02} '.format(session.date.hour, session.date.minute), session.format_short())
+
+        self.assertEqual(session.url(bot), 'https://fahrplan.events.ccc.de/congress/2016/Fahrplan/events/{}.html'.format(session.id))
+        bot.config.c3schedule.session_url = '{{ id }}'
+        self.assertEqual(session.url(bot), str(session.id))
+
+    def test_select_sessions(self):
+        session = next(self.schedule.isessions())
+        speaker = session.persons[0].public_name
+
+        sessions, unknown = select_sessions(self.schedule, '{}, 999999 {}'.format(session.id, session.id))
+        self.assertEqual((sessions, unknown), ([session], [999999]))
+
+        sessions, unknown = select_sessions(self.schedule, 'Speaker: ' + speaker.upper())
+        self.assertIn(session, sessions)
+        self.assertTrue(all(speaker in [p.public_name for p in s.persons] for s in sessions))
+
+        self.assertRaises(ValueError, select_sessions, self.schedule, 'track:')
+        self.assertRaises(ValueError, select_sessions, self.schedule, 'foo')
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now.timestamp()
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, **kwargs):
+        self.now += datetime.timedelta(**kwargs).total_seconds()
+
+
+class RecordingAnnouncer(AnnoucementScheduler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.announced = []
+
+    def announce_starts(self, sessions):
+        self.announced.extend(('start', session.id) for session in sessions)
+
+    def announce_scheduled_starts(self, sessions):
+        self.announced.extend(('scheduled_start', session.id) for session in sessions)
+
+
+class TestAnnoucementScheduler(TestCase):
+    def schedule_json(self):
+        with open('../old1.json', 'r') as fh:
+            return json.loads(fh.read())['schedule']
+
+    def setUp(self):
+        self.schedule = Schedule.from_json(self.schedule_json())
+
+        self.bot = FakeBot()
+        self.bot.memory['c3schedule'] = self.schedule
+        self.clock = FakeClock(parse_day('2016-12-28T10:00:00+01:00'))
+        self.announcer = RecordingAnnouncer(self.bot, clock=self.clock)
+        self.session = self.schedule.next_sessions(parse_day('2016-12-28T11:00:00+01:00'), 1)[0]
+        self.clock.now = self.session.date.timestamp() - 3600
+
+    def test_announcements_fire_in_order(self):
+        self.announcer.add(self.session)
+        self.assertEqual(self.announcer.pending, 2)
+
+        self.assertEqual(self.announcer.run_pending(), 0)
+
+        self.clock.advance(minutes=45)
+        self.assertEqual(self.announcer.run_pending(), 1)
+        self.assertEqual(self.announcer.announced, [('scheduled_start', self.session.id)])
+
+        self.clock.advance(minutes=15)
+        self.assertEqual(self.announcer.run_pending(), 1)
+        self.assertEqual(self.announcer.announced[-1], ('start', self.session.id))
+        self.assertEqual(self.announcer.pending, 0)
+
+    def test_add_is_idempotent(self):
+        self.announcer.add(self.session)
+        self.announcer.add(self.session)
+
+        self.assertEqual(self.announcer.pending, 2)
+
+    def test_cancel(self):
+        self.announcer.add(self.session)
+        self.announcer.cancel(self.session.id)
+        self.assertEqual(self.announcer.pending, 0)
+
+        self.clock.advance(hours=2)
+        self.assertEqual(self.announcer.run_pending(), 0)
+        self.assertEqual(self.announcer.announced, [])
+
+    def test_skips_past_reminder(self):
+        self.clock.advance(minutes=50)
+        self.announcer.add(self.session)
+        self.assertEqual(self.announcer.pending, 1)
+
+        self.clock.advance(minutes=10)
+        self.announcer.run_pending()
+        self.assertEqual(self.announcer.announced, [('start', self.session.id)])
+
+    def test_past_sessions_are_ignored(self):
+        self.clock.advance(hours=2)
+        self.announcer.add(self.session)
+
+        self.assertEqual(self.announcer.pending, 0)
+
+    def test_top_up(self):
+        start = self.clock.now
+        self.announcer.top_up(self.schedule)
+        self.clock.advance(minutes=30)
+        self.announcer.top_up(self.schedule)
+
+        expected = set(s.id for s in self.schedule.isessions() if start <= s.date.timestamp() < start + 90 * 60)
+        self.assertTrue(expected)
+        self.assertEqual(set(self.announcer._events), expected)
+
+    def test_apply_changes(self):
+        self.clock.advance(minutes=10)
+        self.announcer.top_up(self.schedule)
+        pending = self.announcer.pending
+        armed = dict((session_id, dict(events)) for session_id, events in self.announcer._events.items()
+                     if session_id != self.session.id)
+
+        moved_json = self.schedule_json()
+        for day in moved_json['conference']['days']:
+            for sessions in day['rooms'].values():
+                for session_json in sessions:
+                    if session_json['id'] == self.session.id:
+                        session_json['date'] = self.session.date.add(minutes=5).isoformat()
+        new_schedule = self.schedule.patch(moved_json)
+        self.bot.memory['c3schedule'] = new_schedule
+
+        self.announcer.apply_changes(*diff_schedules(self.schedule, new_schedule))
+
+        self.assertEqual(self.announcer.pending, pending)
+        for session_id, events in armed.items():
+            self.assertEqual(self.announcer._events[session_id], events)
+
+        self.clock.advance(minutes=50)
+        self.announcer.run_pending()
+        self.assertNotIn(('start', self.session.id), self.announcer.announced)
+
+        self.clock.advance(minutes=5)
+        self.announcer.run_pending()
+        self.assertEqual(self.announcer.announced.count(('start', self.session.id)), 1)
+
+    def test_apply_changes_cancels_removed(self):
+        self.announcer.add(self.session)
+
+        self.announcer.apply_changes([], [], [self.session])
+
+        self.assertEqual(self.announcer.pending, 0)
+
+    def test_coalesces_announcements(self):
+        self.announcer.coalesce_window = 5
+        sessions = self.schedule.sessions_between(self.session.date, self.session.date.add(seconds=1))
+        self.assertGreater(len(sessions), 1)
+
+        fired = []
+        self.announcer.announce_starts = fired.append
+        self.clock.now = self.session.date.timestamp() - 300
+        for session in sessions:
+            self.announcer.add(session)
+
+        self.clock.now = self.session.date.timestamp() - 3
+        self.assertEqual(self.announcer.run_pending(), 0)
+
+        self.clock.now = self.session.date.timestamp()
+        self.assertEqual(self.announcer.run_pending(), 0)
+
+        self.clock.now = self.session.date.timestamp() + 5
+        self.assertEqual(self.announcer.run_pending(), len(sessions))
+        self.assertEqual(fired, [sessions])
+
+    def test_coalescing_never_fires_early(self):
+        self.announcer.coalesce_window = 5
+        later = self.schedule.sessions_between(self.session.date.add(minutes=1), self.session.date.add(hours=12))[0]
+
+        fired = []
+        self.announcer.announce_starts = fired.append
+        self.clock.now = self.session.date.timestamp() - 300
+        self.announcer.add(self.session)
+        self.announcer.add(later)
+
+        self.clock.now = self.session.date.timestamp() + 5
+        self.assertEqual(self.announcer.run_pending(), 1)
+        self.assertEqual(fired, [[self.session]])
+
+
+class TestDigest(TestCase):
+    def test_pack_lines(self):
+        items = ['a' * 10, 'b' * 10, 'c' * 10]
+
+        self.assertEqual(pack_lines('NOW ', items, ' | ', 100), ['NOW ' + ' | '.join(items)])
+        self.assertEqual(pack_lines('NOW ', items, ' | ', 30), ['NOW ' + 'a' * 10 + ' | ' + 'b' * 10, 'NOW ' + 'c' * 10])
+        self.assertEqual(pack_lines('NOW ', ['ä' * 20], ' | ', 10), ['NOW ' + 'ä' * 20])
+        self.assertEqual(pack_lines('NOW ', [], ' | ', 10), [])
+
+    def test_send_digest_fits_line(self):
+        bot = FakeBot()
+        send_digest(bot, '#schedule', 'NOW ', ['x' * 100] * 20)
+
+        self.assertGreater(len(bot.messages), 1)
+        for target, line in bot.messages:
+            self.assertLessEqual(len(':{}!user@host PRIVMSG {} :{}\r\n'.format(bot.nick, target, line)), 512)
+
+    def test_parse_targmax(self):
+        self.assertEqual(parse_targmax(['CHANTYPES=#', 'TARGMAX=NAMES:1,PRIVMSG:4,NOTICE:4,MONITOR:']), 4)
+        self.assertEqual(parse_targmax(['TARGMAX=PRIVMSG:,NOTICE:']), sys.maxsize)
+        self.assertEqual(parse_targmax(['MAXTARGETS=3']), 3)
+        self.assertIsNone(parse_targmax(['CHANTYPES=#', 'EXCEPTS']))
+
+    def test_send_to_many(self):
+        bot = FakeBot()
+        nicks = ['nick{}'.format(i) for i in range(10)]
+
+        send_to_many(bot, nicks, 'hello', 0)
+        self.assertEqual(bot.messages, [(nick, 'hello') for nick in nicks])
+
+        bot.messages = []
+        bot.memory['c3schedule_targmax'] = 4
+        send_to_many(bot, nicks, 'hello', 0)
+        self.assertEqual([target for target, _ in bot.messages],
+                         [','.join(nicks[:4]), ','.join(nicks[4:8]), ','.join(nicks[8:])])
+
+        bot.messages = []
+        bot.memory['c3schedule_targmax'] = sys.maxsize
+        send_to_many(bot, nicks, 'x' * 350, 0)
+        self.assertGreater(len(bot.messages), 1)
+        self.assertEqual(','.join(target for target, _ in bot.messages), ','.join(nicks))
+        for target, line in bot.messages:
+            self.assertLessEqual(len(':{}!user@host PRIVMSG {} :{}\r\n'.format(bot.nick, target, line)), 512)
+
+
+class TestOutgoingQueue(TestCase):
+    def setUp(self):
+        self.bot = FakeBot()
+        self.clock = FakeClock(pendulum.create(2017, 12, 27))
+        self.queue = OutgoingQueue(self.bot, rate=2, burst=3, target_rate=1, target_burst=2, clock=self.clock)
+
+    def test_priorities(self):
+        self.queue.put(PRIORITY_REPLY, 'PRIVMSG', 'alice', 'reply')
+        self.queue.put(PRIORITY_NOTIFICATION, 'PRIVMSG', 'bob', 'notification')
+        self.queue.put(PRIORITY_ANNOUNCEMENT, 'TOPIC', '#hall', 'topic')
+
+        self.assertEqual(self.queue.send_pending(), (3, None))
+        self.assertEqual(self.bot.messages, [('TOPIC', '#hall :topic'), ('bob', 'notification'), ('alice', 'reply')])
+
+    def test_command_notices_are_replies(self):
+        self.bot.memory['c3schedule_outgoing'] = self.queue
+        trigger = SimpleNamespace(sender='#hall', nick='alice', account=None)
+        self.queue.put(PRIORITY_NOTIFICATION, 'PRIVMSG', 'bob', 'notification')
+
+        require_schedule(lambda bot, trigger: None)(self.bot, trigger)
+        reply(self.bot, trigger, 'Question noted')
+
+        self.assertEqual(self.queue.send_pending(), (3, None))
+        self.assertEqual(self.bot.messages, [
+            ('bob', 'notification'),
+            ('#hall', 'The schedule has not been loaded yet. Please try again in a moment.'),
+            ('#hall', 'alice: Question noted')])
+
+    def test_rate_limits(self):
+        for i in range(3):
+            self.queue.put(PRIORITY_REPLY, 'PRIVMSG', 'alice', 'alice {}'.format(i))
+        self.queue.put(PRIORITY_REPLY, 'PRIVMSG', 'bob', 'bob 0')
+
+        # alice's bucket holds two messages, bob gets the last global token
+        sent, wait = self.queue.send_pending()
+        self.assertEqual(sent, 3)
+        self.assertEqual([text for _, text in self.bot.messages], ['alice 0', 'bob 0', 'alice 1'])
+        self.assertEqual(wait, 0.5)
+
+        self.clock.now += 0.5
+        self.assertEqual(self.queue.send_pending(), (0, 0.5))
+
+        self.clock.now += 0.5
+        self.assertEqual(self.queue.send_pending(), (1, None))
+        self.assertEqual(self.bot.messages[-1], ('alice', 'alice 2'))
+
+        stats = self.queue.stats()[PRIORITY_REPLY]
+        self.assertEqual((stats['queued'], stats['sent'], stats['max_wait']), (0, 4, 1.0))
+
+
+class TestAccountIndex(TestCase):
+    def test_tracks_nicks(self):
+        users = {'alice': SimpleNamespace(nick='alice', account='alice'), 'bob': SimpleNamespace(nick='bob', account=None)}
+        index = AccountIndex.from_users(users)
+        self.assertEqual(index.nicks('alice'), ['alice'])
+
+        index.set('alice_', 'alice')
+        self.assertEqual(sorted(index.nicks('alice')), ['alice', 'alice_'])
+
+        index.rename('alice_', 'alice__')
+        index.set('bob', 'alice')
+        self.assertEqual(sorted(index.nicks('alice')), ['alice', 'alice__', 'bob'])
+
+        index.set('bob', None)
+        index.discard('alice')
+        index.discard('nobody')
+        self.assertEqual(index.nicks('alice'), ['alice__'])
+
+        index.discard('alice__')
+        self.assertEqual(index.nicks('alice'), [])
+        self.assertEqual(index._nicks, {})
+
+
+class FakeDB:
+    def __init__(self, filename):
+        self.filename = filename
+
+    def connect(self):
+        return sqlite3.connect(self.filename)
+
+    def execute(self, *args):
+        with self.connect() as conn:
+            return conn.execute(*args)
+
+
+class TestSubscriptionStore(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = FakeDB(os.path.join(self.tmpdir.name, 'db.sqlite'))
+        setup_database(self.db)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_write_through(self):
+        store = SubscriptionStore.load(self.db)
+        self.assertEqual(store.add('alice', [1, 2, 2]), [1, 2])
+        self.assertEqual(store.add('alice', [2, 3]), [3])
+        self.assertEqual(store.add('bob', [2]), [2])
+        self.assertEqual(store.remove('alice', [1, 4]), [1])
+
+        self.assertEqual(sorted(store.accounts(2)), ['alice', 'bob'])
+        self.assertEqual(store.accounts(1), [])
+
+        store = SubscriptionStore.load(self.db)
+        self.assertEqual(sorted(store.sessions('alice')), [2, 3])
+        self.assertEqual(sorted(store.accounts(2)), ['alice', 'bob'])
+
+
+class TestResponseCache(TestCase):
+    def test_lru(self):
+        cache = ResponseCache(2)
+        cache.put('a', ['a'])
+        cache.put('b', ['b'])
+        self.assertEqual(cache.get('a'), ['a'])
+        cache.put('c', ['c'])
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), ['c'])
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (2, 1, 2))
+
+    def test_nextup_is_cached(self):
+        bot = FakeBot()
+        with open('../old1.json', 'r') as fh:
+            bot.memory['c3schedule'] = Schedule.from_json(json.loads(fh.read())['schedule'])
+        bot.memory['c3schedule_fake_date'] = pendulum.Date(2016, 12, 28)
+        trigger = SimpleNamespace(sender='alice', is_privmsg=True)
+
+        with mock.patch.object(Schedule, 'next_sessions', wraps=bot.memory['c3schedule'].next_sessions) as next_sessions:
+            show_nextup(bot, trigger)
+            show_nextup(bot, trigger)
+
+        self.assertEqual(next_sessions.call_count, 1)
+        self.assertEqual(len(bot.messages), 14)
+        self.assertEqual(bot.messages[:7], bot.messages[7:])
+
+
+class TestTemplates(TestCase):
+    def test_compiled_once(self):
+        reset_templates()
+        self.assertEqual(render_jinja('{{ a }} & {{ b }}', a='<x>', b=1), '<x> & 1')
+        self.assertEqual(render_jinja('{{ a }} & {{ b }}', a='y', b=2), 'y & 2')
+
+        info = compile_template.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+    def test_sandboxed(self):
+        self.assertRaises(jinja2.exceptions.SecurityError, render_jinja, '{{ a.__class__.__subclasses__() }}', a='')
+
+
+class TestRoomRegistry(TestCase):
+    def test_default_rooms(self):
+        rooms = RoomRegistry.parse(DEFAULT_ROOMS)
+
+        self.assertEqual(rooms.channel_for_room('Chaos-West TV'), '#rc3-cwtv')
+        self.assertIsNone(rooms.channel_for_room('chaoszone tv stream'))
+        self.assertIsNone(rooms.channel_for_room('rC1'))
+        self.assertIsNone(rooms.channel_for_room('Saal 1'))
+
+        self.assertEqual(rooms.stream_for_room('rC1'), 'one')
+        self.assertEqual(rooms.stream_for_room('ChaosZone TV Stream'), 'chaoszone')
+        self.assertEqual(rooms.stream_for_room('c-base'), 'c-base')
+        self.assertEqual(rooms.stream_for_room('Saal 1'), 'Saal 1')
+
+        for arg in ('Lichtung', '#RC3-XHAIN', 'rc3-xhain'):
+            self.assertEqual(rooms.channel_from_str(arg), '#rc3-xhain')
+        self.assertIsNone(rooms.channel_from_str('#elsewhere'))
+        self.assertIn('#rc3-xhain', rooms.channels)
+
+
+class TestTopicReconciler(TestCase):
+    def setUp(self):
+        self.sent = []
+        self.clock = FakeClock(pendulum.create(2017, 12, 27))
+        self.topics = TopicReconciler(lambda channel, topic: self.sent.append((channel, topic)), debounce=10,
+                                      clock=self.clock)
+
+    def tearDown(self):
+        self.topics.stop()
+
+    def test_waits_for_actual_topic(self):
+        self.topics.set('#Hall', 'new')
+        self.assertEqual(self.sent, [])
+
+        self.topics.observed('#hall', 'old')
+        self.assertEqual(self.sent, [('#hall', 'new')])
+        self.assertEqual(self.topics.topic('#HALL'), 'old')
+
+        self.topics.observed('#hall', 'new')
+        self.topics.set('#hall', 'new')
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.topics.topic('#HALL'), 'new')
+
+    def test_own_topic_is_settled(self):
+        self.topics.observed('#hall', 'old')
+        self.topics.set('#hall', 'x' * 500)
+        self.assertEqual(len(self.sent), 1)
+
+        # our change, truncated by the server
+        self.clock.now += 10
+        self.topics.observed('#hall', 'x' * 390, ours=True)
+        self.topics.set('#hall', 'x' * 500)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.topics.topic('#hall'), 'x' * 390)
+
+        self.topics.set('#hall', 'y' * 10)
+        self.assertEqual(self.sent[-1], ('#hall', 'y' * 10))
+
+    def test_restores_topic_changed_by_others(self):
+        self.topics.observed('#hall', 'old')
+        self.topics.set('#hall', 'new')
+        self.topics.observed('#hall', 'new', ours=True)
+
+        self.topics.observed('#hall', 'changed by an op')
+        self.assertEqual(len(self.sent), 1)
+        self.assertIn('#hall', self.topics._timers)
+        self.assertEqual(self.topics.topic('#hall'), 'changed by an op')
+
+        self.clock.now += 10
+        self.topics.reconcile('#hall')
+        self.assertEqual(self.sent, [('#hall', 'new'), ('#hall', 'new')])
+
+    def test_start_seeds_channels_without_topic(self):
+        bot = FakeBot()
+        bot.config.c3schedule.topic_debounce = 10
+        bot.channels = {'#hall': SimpleNamespace(topic=''), '#other': SimpleNamespace(topic='old')}
+        start_topics(bot)
+        try:
+            bot.memory['c3schedule_topics'].set('#hall', 'new')
+        finally:
+            stop_topics(bot)
+
+        self.assertEqual(bot.memory['c3schedule_topics'], None)
+        self.assertEqual(bot.messages, [('TOPIC', '#hall :new')])
+
+    def test_debounce(self):
+        self.topics.observed('#hall', 'old')
+        self.topics.set('#hall', 'first')
+        self.topics.set('#hall', 'second')
+        self.topics.set('#hall', 'third')
+
+        self.assertEqual(self.sent, [('#hall', 'first')])
+        self.assertIn('#hall', self.topics._timers)
+
+        self.clock.now += 10
+        self.topics.reconcile('#hall')
+        self.assertEqual(self.sent, [('#hall', 'first'), ('#hall', 'third')])